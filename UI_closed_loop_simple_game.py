@@ -8,11 +8,24 @@ import yaml
 import random 
 import time 
 
-from pylsl import StreamInlet, StreamOutlet, StreamInfo, resolve_streams
-from psychopy import visual, event, logging, core
+from pylsl import StreamInlet, StreamOutlet, StreamInfo, resolve_streams, local_clock
+
+from stimuli.StimulusEngine import StimulusEngine
+from stimuli.FrameTelemetry import FrameTelemetry, N_CHANNELS
+from stimuli.TargetLayout import TargetLayout, DIRECTIONS
+from experiment.LabelSequence import LabelSequence
+from profiling.Profiler import Profiler
+from streams.SharedRing import RingInlet, RingOutlet, open_inlet, shared_memory_streams
+from streams.SharedRing import MAX_LENGTH, max_string_length
+
+# PsychoPy takes seconds to import, so it is only imported (by import_psychopy)
+# after the config is read and the streams are connected
+visual = event = logging = core = None
+
+def import_psychopy():
+	global visual, event, logging, core
+	from psychopy import visual, event, logging, core
 
-OBJ = 0
-FREQ = 1
 
 class Ui():
 
@@ -23,6 +36,8 @@ class Ui():
 		self.outlets = {}  # Trial flags
 		self.inlet_names = []
 		self.outlet_names = []
+		self.shared_memory_streams = []  # Streams to/from the decoder that don't use LSL
+		self.max_marker_length = MAX_LENGTH  # Bytes, shared memory only
 
 		# Window opts
 		self.win = None
@@ -39,19 +54,29 @@ class Ui():
 		self.exp_duration = 30  # s
 		self.trial_length = .5  # s
 		self.frames_per_trial = None
-		self.freqs = {'top': 0,
-					  'right': 0,
-					  'bottom': 0,
-					  'left': 0}
+		self.targets = None  # TargetLayout
 
 		# Game
 		self.speed = 0.01
 		self.boundary = 0.6  # Relative to screen size.
+		self.command_mode = 'latest'  # latest or accumulate
+		self.smoothing_frames = 1  # Frames to move the player over per command
+		self.marker_interval = 0  # Minimal seconds between player position markers
+		self.pl_goal = None
+		self.last_marker_time = 0
+		self.last_marker_pos = None
 
 		# Stimulus
-		self.stims = []
+		self.stim_mode = 'flash'
+		self.stim_engine = None
+		self.score_stim = None
 		self.command_mapping = {}
 		self.refresh_threshold = None
+		self.frame_telemetry = None
+
+		# Profiling (config: profiling, or SIGUSR1)
+		self.profiler = None
+		self.profile_on_start = False
 
 
 	def load_config(self, filename):
@@ -66,19 +91,35 @@ class Ui():
 		self.mon_refr_rate = conf['ui']['monitorRefreshRate']
 		self.refresh_threshold = conf['ui']['refreshThreshold']
 		self.frames_per_trial = self.mon_refr_rate * self.trial_length
+		self.stim_mode = conf['ui'].get('stimulusMode', 'flash')
+
+		game = conf['ui'].get('game', {})
+		self.command_mode = game.get('commandMode', self.command_mode)
+		self.smoothing_frames = game.get('smoothingFrames', self.smoothing_frames)
+		self.marker_interval = game.get('positionMarkerInterval', self.marker_interval)
 
-		self.command_mapping = conf['experiment']['commandMapping']
+		self.targets = TargetLayout(conf)
+		if self.targets.layout != DIRECTIONS:
+			raise ValueError('The game needs the {} layout (config: ui: layout)'.format(DIRECTIONS))
+		self.command_mapping = self.targets.command_mapping
 
 		self.trial_length = conf['experiment']['trialLength']
-		self.freqs = conf['experiment']['stimulusFrequencies']
 
 		self.inlet_names = conf['streams']['SSVEPui']['inlet_names']
 		self.outlet_names = conf['streams']['SSVEPui']['outlet_names']
+		self.shared_memory_streams = shared_memory_streams(conf)
+		self.max_marker_length = max_string_length(conf)
 
 		if 'labelFile' in conf['classifier']:
 			self.labels = self.read_label_file(conf['classifier']['labelFile'])
 
-		lvl = eval('logging.{}'.format(conf['ui']['loggingLevel']))
+		self.loggingLevel = conf['ui']['loggingLevel']
+
+		self.profiler = Profiler.from_config('ui', conf)
+		self.profile_on_start = bool(conf.get('profiling', {}).get('enabled'))
+
+	def setup_logging(self):
+		lvl = getattr(logging, self.loggingLevel)
 		logging.console.setLevel(lvl)
 
 	def setup_win(self):
@@ -92,42 +133,77 @@ class Ui():
 
 		# Calculate ratio to normalize the size values
 		self.win_ratio = self.win.size[0] / self.win.size[1]
-		stim_size_x = 1
-		stim_size_y = 1
-		self.add_stim(visual.Rect(self.win, pos=(0, 1), size=(stim_size_x, stim_size_y*self.win_ratio), fillColor="#FFFFFFF"), self.freqs['top']) # Up
-		self.add_stim(visual.Rect(self.win, pos=(0, -1), size=(stim_size_x, stim_size_y*self.win_ratio), fillColor="#FFFFFFF"), self.freqs['bottom']) # Down
-		self.add_stim(visual.Rect(self.win, pos=(-1, 0), size=(stim_size_x, stim_size_y*self.win_ratio), fillColor="#FFFFFFF"), self.freqs['left']) # Left
-		self.add_stim(visual.Rect(self.win, pos=(1, 0), size=(stim_size_x, stim_size_y*self.win_ratio), fillColor="#FFFFFFF"),  self.freqs['right']) # Right
+		self.stim_engine = StimulusEngine(self.mon_refr_rate, self.stim_mode)
+		for target in self.targets:
+			width, height = target.size
+			self.add_stim(visual.Rect(self.win, pos=target.pos, size=(width, height*self.win_ratio), fillColor="#FFFFFFF"),
+						  target.frequency, target.phase)
 
-		# Use for psychopy version 2020+
-		# self.add_stim(visual.Rect(self.win, pos=(0, 1), size=(stim_size_x, stim_size_y*self.win.aspect), fillColor="#FFFFFFF"), self.freqs['top']) # Up
-		# self.add_stim(visual.Rect(self.win, pos=(0, -1), size=(stim_size_x, stim_size_y*self.win.aspect), fillColor="#FFFFFFF"), self.freqs['bottom']) # Down
-		# self.add_stim(visual.Rect(self.win, pos=(-1, 0), size=(stim_size_x, stim_size_y*self.win.aspect), fillColor="#FFFFFFF"), self.freqs['left']) # Left
-		# self.add_stim(visual.Rect(self.win, pos=(1, 0), size=(stim_size_x, stim_size_y*self.win.aspect), fillColor="#FFFFFFF"),  self.freqs['right']) # Right
+		# Use self.win.aspect instead of self.win_ratio for psychopy version 2020+
 
 
 	def read_label_file(self, filename):
-		try:
-			with open(filename, 'r') as f:
-				labels = f.read()
-			return [int(l) for l in list(labels)]
-		except Exception as err:
-			raise
+		''' The labels are read when the first trial starts (see experiment/LabelSequence.py) '''
+		return LabelSequence(filename)
+
+	def add_stim(self, obj, freq, phase=0):
+		self.stim_engine.add_stim(obj, freq, phase)
+
+	def start_profiler(self):
+		''' Profiles the frame loop now (if enabled) or when SIGUSR1 is received '''
+		if self.profiler is None:
+			return
+		self.profiler.install_signal()
+		if self.profile_on_start:
+			self.profiler.start()
+
+	def enter(self, stage):
+		''' Tags the profile samples with the stage of the frame loop '''
+		if self.profiler is not None:
+			self.profiler.enter(stage)
+
+	def flip(self):
+		''' Flips the window and registers the flip for the frame telemetry '''
+		self.win.flip()
+		if self.frame_telemetry is not None:
+			self.frame_telemetry.flipped(local_clock())
 
-	def add_stim(self, obj, freq):
-		self.stims += [(obj, freq)]
+	def close_streams(self):
+		''' Closes the shared memory streams, which removes the blocks of the outlets '''
+		for streams in [self.outlets, self.inlets]:
+			for name in [name for name, stream in streams.items() if isinstance(stream, (RingOutlet, RingInlet))]:
+				streams.pop(name).close()
 
 	def setup_streams(self):
 		# Outlets
 		# Start/stop markers
 		stream_name = self.outlet_names[0]
-		info = StreamInfo(stream_name, 'Markers', 1, 0, 'string', 'UiOutput1')
-		self.outlets[stream_name] = StreamOutlet(info)
+		if stream_name in self.shared_memory_streams:
+			self.outlets[stream_name] = RingOutlet(stream_name, 'string', max_length=self.max_marker_length)
+		else:
+			info = StreamInfo(stream_name, 'Markers', 1, 0, 'string', 'UiOutput1')
+			self.outlets[stream_name] = StreamOutlet(info)
+
+		# Frame timing telemetry (optional second outlet)
+		if len(self.outlet_names) > 1:
+			stream_name = self.outlet_names[1]
+			info = StreamInfo(stream_name, 'FrameTiming', N_CHANNELS, self.mon_refr_rate, 'double64', 'UiFrames1')
+			self.outlets[stream_name] = StreamOutlet(info)
+			threshold = 1/self.mon_refr_rate + self.refresh_threshold if self.refresh_threshold is not None \
+						else 1.2/self.mon_refr_rate
+			self.frame_telemetry = FrameTelemetry(self.outlets[stream_name], threshold,
+												  batch_size=int(self.mon_refr_rate/2), flush_interval=0.1)
 
 		# StreamInlets
 		# See also: resolve_byprop, resolve_pypred
 		print('Searching for stream inlets...')
 		while len(self.inlets) < len(self.inlet_names):
+			for name in self.shared_memory_streams:
+				if name in self.inlet_names and name not in self.inlets:
+					inlet = open_inlet(name)
+					if inlet is not None:
+						self.inlets[name] = inlet
+
 			# Iterate over LSL streams and connect them to an outlet
 			streams = resolve_streams(wait_time=1.0)
 			for stream in streams:
@@ -149,6 +225,8 @@ class Ui():
 		self.setup_streams()
 
 		# GUI
+		import_psychopy()
+		self.setup_logging()
 		self.setup_win()
 		self.setup_stims()
 
@@ -159,41 +237,59 @@ class Ui():
 		self.pl = visual.Rect(self.win, pos=(0, 0), size=(.1, .1), fillColor="grey", lineColor="grey")
 		self.pl.autoDraw = True
 		self.target = visual.Rect(self.win, pos=(.5, .5), size=(.1, .1), fillColor="green", lineColor="green")
+		self.target.autoDraw = True
+		self.pl_goal = [0, 0]
 
 		self.send_player_marker()
 		self.send_target_marker()
 
-	def move_obj(self, obj, dir):
-		''' Move the player. Arrows keys implemented for debugging purposes'''
+	def move_player(self, dir):
+		''' Move the goal position of the player, the player itself moves
+		there over the next frames (see update_player). Arrows keys
+		implemented for debugging purposes'''
+		goal = self.pl_goal
 
 		# Arrowkeys
 		if dir == 'left':
-			obj.pos += (-self.speed-.05, 0)
+			goal[0] += -self.speed-.05
 		elif dir == 'right':
-			obj.pos += (self.speed+.05, 0)
+			goal[0] += self.speed+.05
 		elif dir == 'up':
-			obj.pos += (0, self.speed+.05)
+			goal[1] += self.speed+.05
 		elif dir == 'down':
-			obj.pos += (0, -self.speed-.05)
+			goal[1] += -self.speed-.05
 			
 
 		# Move using command_mapping
 		if dir == self.command_mapping['left'] and \
-		   abs(obj.pos[0]) + self.speed <= self.boundary:
-			obj.pos += (-self.speed, 0)
+		   abs(goal[0]) + self.speed <= self.boundary:
+			goal[0] += -self.speed
 		elif dir == self.command_mapping['right'] and \
-			 abs(obj.pos[0]) + self.speed <= self.boundary:
-			obj.pos += (self.speed, 0)
+			 abs(goal[0]) + self.speed <= self.boundary:
+			goal[0] += self.speed
 		elif dir == self.command_mapping['top'] and \
-			 abs(obj.pos[1]) + self.speed <= self.boundary:
-			obj.pos += (0, self.speed)
-		elif dir == self.command_mapping['down'] and \
-			 abs(obj.pos[1]) + self.speed <= self.boundary:
-			obj.pos += (0, -self.speed)
+			 abs(goal[1]) + self.speed <= self.boundary:
+			goal[1] += self.speed
+		elif dir == self.command_mapping['bottom'] and \
+			 abs(goal[1]) + self.speed <= self.boundary:
+			goal[1] += -self.speed
 		else:
 			pass
-		
-		self.send_player_marker()
+
+	def update_player(self):
+		''' Moves the player towards its goal position with at most
+		speed/smoothing_frames per frame and sends the position marker if
+		the player moved and the last marker is old enough '''
+		max_step = self.speed / self.smoothing_frames
+		pos = self.pl.pos
+		step = [min(max(g - p, -max_step), max_step) for g, p in zip(self.pl_goal, pos)]
+		if step[0] != 0 or step[1] != 0:
+			self.pl.pos = (pos[0] + step[0], pos[1] + step[1])
+
+		moved = self.last_marker_pos is None or \
+				tuple(self.pl.pos) != self.last_marker_pos
+		if moved and time.time() - self.last_marker_time >= self.marker_interval:
+			self.send_player_marker()
 
 	def send_flags(self, stream_name, ts, msg):
 		self.outlets[stream_name].push_sample([msg])
@@ -201,16 +297,24 @@ class Ui():
 	def send_player_marker(self):
 		msg = 'playerposition_{}_{}'.format(self.pl.pos[0], self.pl.pos[1])
 		self.outlets['UiOutput'].push_sample([msg])
+		self.last_marker_time = time.time()
+		self.last_marker_pos = tuple(self.pl.pos)
 
 	def send_target_marker(self):
 		msg = 'targetposition_{}_{}'.format(self.target.pos[0], self.target.pos[1])
 		self.outlets['UiOutput'].push_sample([msg])
 
 	def apply_commands(self, stream_name):
-		''' Read classification and apply to object'''
-		inp, timestamp = self.inlets[stream_name].pull_sample(timeout=0.0)
-		if inp:
-			self.move_obj(self.pl, int(inp[0]))
+		''' Read all pending classifications and apply them to the player.
+		Depending on command_mode only the latest command is applied or all
+		commands are accumulated '''
+		chunk, timestamps = self.inlets[stream_name].pull_chunk(timeout=0.0)
+		if len(chunk) == 0:
+			return
+		if self.command_mode == 'latest':
+			chunk = chunk[-1:]
+		for inp in chunk:
+			self.move_player(int(inp[0]))
 
 
 	def wait_for_user(self):
@@ -237,7 +341,7 @@ class Ui():
 		Draws the direction for the user to look at and waits for 1 second
 		'''
 
-		txt = [t[0] for t in self.command_mapping.items() if t[1] == direction][0]
+		txt = self.targets[direction].name
 		if txt == 'top':
 			txt = '\u21e6'
 		txtStim = visual.TextStim(self.win, text=txt, pos=(0.90,0), alignHoriz='center')
@@ -250,10 +354,14 @@ class Ui():
 		keys = event.getKeys()
 		if 'escape' in keys:
 			self.esc_pressed = True
+		if 'r' in keys:
+			# Undo the recent adaptation of the classifier (adaptive_cca)
+			print('Rollback')
+			self.send_flags('UiOutput', self.timer.getTime(), 'rollback')
 		for k in ['left', 'right', 'up', 'down']:
 			if k in keys:
 				print(k)
-				self.move_obj(self.pl, k)
+				self.move_player(k)
 
 
 	def place_target(self):
@@ -268,11 +376,21 @@ class Ui():
 		'''Returns true if player overlaps the target'''
 		return self.pl.overlaps(self.target)
 
+	def draw_score(self):
+		''' (Re)creates the score text. Only called when the score changes,
+		text rendering is too expensive to do every frame '''
+		if self.score_stim is not None:
+			self.score_stim.autoDraw = False
+		score_txt = 'Score: {} van {}'.format(self.pl_score, self.total_score)
+		self.score_stim = visual.TextStim(self.win, text=score_txt, pos=(0,0.9), height=0.1)
+		self.score_stim.autoDraw = True
+
 	def update_score(self):
 		''' Updates the scoreObj and makes sure a new goal will be placed '''
 		self.pl_score += 1
 		txt = "goal {} reached".format(self.pl_score)
 		self.send_flags('UiOutput', self.timer.getTime(), txt)
+		self.draw_score()
 		self.place_target()
 
 
@@ -292,40 +410,54 @@ class Ui():
 		self.pl_score = 0
 		self.esc_pressed = False
 		self.total_score = 10  # TODO: Place in Config
+		self.draw_score()
+
+		# Precompute the timing of all stimuli
+		self.stim_engine.build_schedule()
 		fnum = 0
+
 		self.send_flags('UiOutput', self.timer.getTime(), 'experiment_start')
+		self.start_profiler()
 		while not self.esc_pressed and self.pl_score < self.total_score:
 			t = time.time()
+			self.enter('keys')
 			self.check_keys()
 
+			self.enter('commands')
 			self.apply_commands('UiInput')
+			self.enter('player')
+			self.update_player()
 
 			if self.player_reached_target():
+				self.enter('score')
 				self.update_score()
 
-			# Draw everything
-			for stim in self.stims:
-				if fnum % stim[FREQ] == 0:
-					stim[OBJ].draw()
-
-			score_txt = 'Score: {} van {}'.format(self.pl_score, self.total_score)
-			score_stim = visual.TextStim(self.win, text=score_txt, pos=(0,0.9), height=0.1)
-			score_stim.draw()
-			self.target.draw()
+			# Draw flickering stimuli, static elements are drawn automatically
+			self.enter('draw')
+			self.stim_engine.draw(fnum)
 
-			self.win.flip()
+			self.enter('flip')
+			self.flip()
 			
 			fnum += 1
+
 			passed_time = time.time() - t
 			if passed_time > 0.1:
 				print('Time per loop: {0:.2f}s'.format(time.time() - t))
 		
+		if self.frame_telemetry is not None:
+			self.frame_telemetry.flush()
+		if self.profiler is not None:
+			self.profiler.stop()
 
 		self.outlets['UiOutput'].push_sample(['experiment_end'])
 
 if __name__ == '__main__':
 	ui = Ui()
-	ui.setup()
-	ui.run()
+	try:
+		ui.setup()
+		ui.run()
+	finally:
+		ui.close_streams()
 
 #TODO: Full screen changes shapes, (maybe port it to the next version anyway)
\ No newline at end of file
@@ -6,11 +6,24 @@ terms of the MIT license.
 
 import yaml
 
-from pylsl import StreamInlet, StreamOutlet, StreamInfo, resolve_streams
-from psychopy import visual, event, logging, core
+from pylsl import StreamInlet, StreamOutlet, StreamInfo, resolve_streams, local_clock
+
+from stimuli.StimulusEngine import StimulusEngine
+from stimuli.FrameTelemetry import FrameTelemetry, N_CHANNELS
+from stimuli.TargetLayout import TargetLayout, DIRECTIONS
+from experiment.LabelSequence import LabelSequence
+from profiling.Profiler import Profiler
+from streams.SharedRing import RingInlet, RingOutlet, open_inlet, shared_memory_streams
+from streams.SharedRing import MAX_LENGTH, max_string_length
+
+# PsychoPy takes seconds to import, so it is only imported (by import_psychopy)
+# after the config is read and the streams are connected
+visual = event = logging = core = None
+
+def import_psychopy():
+	global visual, event, logging, core
+	from psychopy import visual, event, logging, core
 
-OBJ = 0
-FREQ = 1
 
 class Ui():
 
@@ -21,6 +34,8 @@ class Ui():
 		self.outlets = {}  # Trial flags
 		self.inlet_names = []
 		self.outlet_names = []
+		self.shared_memory_streams = []  # Streams to/from the decoder that don't use LSL
+		self.max_marker_length = MAX_LENGTH  # Bytes, shared memory only
 
 		# Window opts
 		self.win = None
@@ -37,17 +52,20 @@ class Ui():
 		self.exp_duration = 30  # s
 		self.trial_length = .5  # s
 		self.frames_per_trial = self.mon_refr_rate * self.trial_length
-		self.freqs = {'top': 0,
-					  'right': 0,
-					  'bottom': 0,
-					  'left': 0}
+		self.targets = None  # TargetLayout
 
 		# Stimulus
-		self.stims = []
+		self.stim_mode = 'flash'
+		self.stim_engine = None
 		self.commandVis = None
 		self.command_mapping = {}
 
 		self.refresh_threshold = None
+		self.frame_telemetry = None
+
+		# Profiling (config: profiling, or SIGUSR1)
+		self.profiler = None
+		self.profile_on_start = False
 
 
 	def load_config(self, filename):
@@ -62,22 +80,31 @@ class Ui():
 		self.mon_refr_rate = conf['ui']['monitorRefreshRate']
 		self.refresh_threshold = conf['ui']['refreshThreshold']
 		self.frames_per_trial = self.mon_refr_rate * self.trial_length
+		self.stim_mode = conf['ui'].get('stimulusMode', 'flash')
 
-		self.command_mapping = conf['experiment']['commandMapping']
+		self.targets = TargetLayout(conf)
+		self.command_mapping = self.targets.command_mapping
 
 		self.trial_length = conf['experiment']['trialLength']
-		self.freqs = conf['experiment']['stimulusFrequencies']
 
 		self.inlet_names = conf['streams']['SSVEPui']['inlet_names']
 		self.outlet_names = conf['streams']['SSVEPui']['outlet_names']
+		self.shared_memory_streams = shared_memory_streams(conf)
+		self.max_marker_length = max_string_length(conf)
 
 		if 'labelFile' in conf['classifier']:
 			self.labels = self.read_label_file(conf['classifier']['labelFile'])
 
-		lvl = eval('logging.{}'.format(conf['ui']['loggingLevel'])) # Remember that using eval with input a security hole
-		logging.console.setLevel(lvl)
+		self.loggingLevel = conf['ui']['loggingLevel']
+
+		self.profiler = Profiler.from_config('ui', conf)
+		self.profile_on_start = bool(conf.get('profiling', {}).get('enabled'))
 
 
+	def setup_logging(self):
+		lvl = getattr(logging, self.loggingLevel)
+		logging.console.setLevel(lvl)
+
 	def setup_win(self):
 		self.win = visual.Window(self.window_size, fullscr=self.fullscreen, color=self.window_color, gammaErrorPolicy='warn')
 
@@ -90,23 +117,43 @@ class Ui():
 
 		# Calculate ratio to normalize the size values
 		ratio = self.win.size[0] / self.win.size[1]
-		stim_size_x = 1
-		stim_size_y = 1
-		self.add_stim(visual.Rect(self.win, pos=(0, 1), size=(stim_size_x, stim_size_y*ratio), fillColor="#FFFFFFF"), self.freqs['top']) # Up
-		self.add_stim(visual.Rect(self.win, pos=(0, -1), size=(stim_size_x, stim_size_y*ratio), fillColor="#FFFFFFF"), self.freqs['bottom']) # Down
-		self.add_stim(visual.Rect(self.win, pos=(-1, 0), size=(stim_size_x, stim_size_y*ratio), fillColor="#FFFFFFF"), self.freqs['left']) # Left
-		self.add_stim(visual.Rect(self.win, pos=(1, 0), size=(stim_size_x, stim_size_y*ratio), fillColor="#FFFFFFF"),  self.freqs['right']) # Right
+		self.stim_engine = StimulusEngine(self.mon_refr_rate, self.stim_mode)
+		for target in self.targets:
+			width, height = target.size
+			if self.targets.layout == DIRECTIONS:
+				height *= ratio
+			self.add_stim(visual.Rect(self.win, pos=target.pos, size=(width, height), fillColor="#FFFFFFF"),
+						  target.frequency, target.phase)
+			if self.targets.layout != DIRECTIONS:
+				# Symbols of the speller, drawn on top of the stimuli
+				symbol = visual.TextStim(self.win, text=target.name, pos=target.pos, height=height/2, color='grey')
+				symbol.autoDraw = True
 
 	def read_label_file(self, filename):
-		try:
-			with open(filename, 'r') as f:
-				labels = f.read()
-			return [int(l) for l in list(labels)]
-		except Exception as err:
-			raise
-
-	def add_stim(self, obj, freq):
-		self.stims += [(obj, freq)]
+		''' The labels are read when the first trial starts (see experiment/LabelSequence.py) '''
+		return LabelSequence(filename)
+
+	def add_stim(self, obj, freq, phase=0):
+		self.stim_engine.add_stim(obj, freq, phase)
+
+	def start_profiler(self):
+		''' Profiles the frame loop now (if enabled) or when SIGUSR1 is received '''
+		if self.profiler is None:
+			return
+		self.profiler.install_signal()
+		if self.profile_on_start:
+			self.profiler.start()
+
+	def enter(self, stage):
+		''' Tags the profile samples with the stage of the frame loop '''
+		if self.profiler is not None:
+			self.profiler.enter(stage)
+
+	def flip(self):
+		''' Flips the window and registers the flip for the frame telemetry '''
+		self.win.flip()
+		if self.frame_telemetry is not None:
+			self.frame_telemetry.flipped(local_clock())
 
 	def setup_command(self):
 
@@ -115,17 +162,42 @@ class Ui():
 		self.add_stim(sq, 1)
 		self.commandVis = sq
 
+	def close_streams(self):
+		''' Closes the shared memory streams, which removes the blocks of the outlets '''
+		for streams in [self.outlets, self.inlets]:
+			for name in [name for name, stream in streams.items() if isinstance(stream, (RingOutlet, RingInlet))]:
+				streams.pop(name).close()
+
 	def setup_streams(self):
 		# Outlets
 		# Start/stop markers
 		stream_name = self.outlet_names[0]
-		info = StreamInfo(stream_name, 'Markers', 1, 0, 'string', 'UiOutput1')
-		self.outlets[stream_name] = StreamOutlet(info)
+		if stream_name in self.shared_memory_streams:
+			self.outlets[stream_name] = RingOutlet(stream_name, 'string', max_length=self.max_marker_length)
+		else:
+			info = StreamInfo(stream_name, 'Markers', 1, 0, 'string', 'UiOutput1')
+			self.outlets[stream_name] = StreamOutlet(info)
+
+		# Frame timing telemetry (optional second outlet)
+		if len(self.outlet_names) > 1:
+			stream_name = self.outlet_names[1]
+			info = StreamInfo(stream_name, 'FrameTiming', N_CHANNELS, self.mon_refr_rate, 'double64', 'UiFrames1')
+			self.outlets[stream_name] = StreamOutlet(info)
+			threshold = 1/self.mon_refr_rate + self.refresh_threshold if self.refresh_threshold is not None \
+						else 1.2/self.mon_refr_rate
+			self.frame_telemetry = FrameTelemetry(self.outlets[stream_name], threshold,
+												  batch_size=int(self.mon_refr_rate/2), flush_interval=0.1)
 
 		# StreamInlets
 		# See also: resolve_byprop, resolve_pypred
 		print('Searching for stream inlets...')
 		while len(self.inlets) < len(self.inlet_names):
+			for name in self.shared_memory_streams:
+				if name in self.inlet_names and name not in self.inlets:
+					inlet = open_inlet(name)
+					if inlet is not None:
+						self.inlets[name] = inlet
+
 			# Iterate over LSL streams and connect them to an outlet
 			streams = resolve_streams(wait_time=1.0)
 			for stream in streams:
@@ -148,6 +220,8 @@ class Ui():
 		self.setup_streams()
 
 		# GUI
+		import_psychopy()
+		self.setup_logging()
 		self.setup_win()
 		self.setup_stims()
 
@@ -159,7 +233,7 @@ class Ui():
 			obj.pos += (0.01, 0)
 		elif dir == self.command_mapping['top']:
 			obj.pos += (0, 0.01)
-		elif dir == self.command_mapping['down']:
+		elif dir == self.command_mapping['bottom']:
 			obj.pos += (0, -0.01)
 
 
@@ -195,7 +269,7 @@ class Ui():
 		Draws the direction for the user to look at and waits for 1 second
 		'''
 
-		txt = [t[0] for t in self.command_mapping.items() if t[1] == direction][0]
+		txt = self.targets[direction].name
 		# CONS: Change to unicode arrows here
 		# if txt == 'top':
 		# 	txt = '\u21e6'
@@ -210,6 +284,9 @@ class Ui():
 		'''
 		# calculate the length of the trials in frames
 		nFrames = self.trial_length * self.mon_refr_rate
+
+		# Precompute the timing of all stimuli
+		self.stim_engine.build_schedule()
 		
 		# Calculate some random classes
 		self.wait_for_user()
@@ -217,8 +294,10 @@ class Ui():
 		timer =core.Clock()
 
 		self.send_flags('UiOutput', timer.getTime(), 'experiment_start')
+		self.start_profiler()
 		for ntr, trial in enumerate(self.labels):
 
+			self.enter('between_trials')
 			self.instruct_user(trial)
 
 			# print('Starting exp for %is (%i Frames)' % (self.exp_duration, nFrames))
@@ -233,12 +312,16 @@ class Ui():
 				# Some framedrops? Check if all LSL connections are working
 
 				# Draw objects
-				for stim in self.stims:
-					if fnum % stim[FREQ] == 0: stim[OBJ].draw()
+				self.enter('draw')
+				self.stim_engine.draw(fnum)
 
-				self.win.flip()
+				self.enter('flip')
+				self.flip()
 			# END CRITICAL PART
 
+			if self.frame_telemetry is not None:
+				self.frame_telemetry.pause()
+
 			self.win.recordFrameIntervals = False
 			# Send trial information
 			self.send_flags('UiOutput', timer.getTime(), 'trial_end')
@@ -253,11 +336,17 @@ class Ui():
 			if 'escape' in event.getKeys(): 
 				break
 
+		if self.profiler is not None:
+			self.profiler.stop()
+
 		# Let the decoder know the experiment is finished
 		self.outlets['UiOutput'].push_sample(['experiment_end'])
 
 
 if __name__ == '__main__':
 	ui = Ui()
-	ui.setup()
-	ui.run()
+	try:
+		ui.setup()
+		ui.run()
+	finally:
+		ui.close_streams()
@@ -0,0 +1,210 @@
+'''
+Copyright (C) 2019 Maarten Ottenhoff.
+You may use, distribute and modify this code under the
+terms of the MIT license.
+
+asyncio version of the decoder. Uses the same config and stages as
+decoder.py, but resolves all streams concurrently, reconnects lost inlets
+without clearing the buffers, and runs EEG ingestion, frame telemetry,
+marker handling, classification (in an executor) and publishing as
+independent tasks.
+'''
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pylsl import StreamInlet, resolve_byprop
+try:
+	from pylsl import LostError
+except ImportError:
+	from pylsl.util import LostError  # Newer pylsl versions
+
+from decoder import Decoder
+from streams.StreamClock import StreamClock
+from streams.SharedRing import open_inlet
+
+
+class LatencyStats():
+	''' Collects the duration of every iteration of every task '''
+
+	def __init__(self):
+		self.durations = {}
+
+	def record(self, task, seconds):
+		self.durations.setdefault(task, []).append(seconds)
+
+	def report(self):
+		print('\nTask latencies (ms):')
+		print('\t{:<20s} {:>7s} {:>7s} {:>7s} {:>7s}'.format('task', 'n', 'mean', 'p95', 'max'))
+		for task, durations in self.durations.items():
+			durations = np.array(durations) * 1000
+			print('\t{:<20s} {:>7d} {:>7.2f} {:>7.2f} {:>7.2f}'.format(
+				  task, len(durations), durations.mean(), np.percentile(durations, 95), durations.max()))
+
+
+class AsyncDecoder(Decoder):
+	''' Decoder with an asyncio runtime, see the module docstring '''
+
+	def __init__(self):
+		super().__init__()
+
+		self.idle_sleep = 0.002  # Seconds to wait if a stream has no new data
+		self.executor = None
+		self.data_event = None
+		self.results_queue = None
+		self.trial_ready = False
+		self.latency = LatencyStats()
+
+	async def resolve(self, name):
+		''' Waits until the stream with this name is found and returns an inlet '''
+		loop = asyncio.get_running_loop()
+		while name in self.shared_memory_streams:
+			inlet = open_inlet(name)
+			if inlet is not None:
+				return inlet
+			await asyncio.sleep(0.1)
+
+		while True:
+			streams = await loop.run_in_executor(None, resolve_byprop, 'name', name, 1, 1.0)
+			if streams:
+				# Reconnecting is done here, so let pull_* raise LostError
+				return StreamInlet(streams[0], recover=False)
+			print('Waiting for stream: {}'.format(name))
+
+	async def connect_streams_async(self):
+		''' Creates the outlet and resolves all inlets concurrently '''
+		self.create_outlets()
+
+		print('Searching for stream inlets...')
+		inlets = await asyncio.gather(*[self.resolve(name) for name in self.inlet_names])
+		self.inlets = dict(zip(self.inlet_names, inlets))
+
+		print('''\nDecoder connected to streams:\n\tInlets: {}\n\tOutlets: {}'''
+				.format(list(self.inlets.keys()), list(self.outlets.keys())))
+
+	async def reconnect(self, name):
+		''' Replaces a lost inlet, the buffers are kept '''
+		print('Lost stream {}, reconnecting...'.format(name))
+		t = time.perf_counter()
+		self.inlets[name] = await self.resolve(name)
+
+		if name in self.clocks:
+			self.clocks[name].stop()
+			srate = 0
+			first_index = 0
+			if name == self.eeg_inlet_name:
+				srate = self.inlets[name].info().nominal_srate()
+				first_index = self.buffer_start_index + len(self.data_buffer)
+			self.clocks[name] = StreamClock(self.inlets[name], nominal_srate=srate,
+											first_index=first_index)
+			self.clocks[name].start()
+
+		if name == self.eeg_inlet_name:
+			self.inlet_monitor.reset(self.inlets[name])
+			if self.artifact_detector is not None:
+				self.artifact_detector.reset()
+
+		self.latency.record('reconnect', time.perf_counter() - t)
+		print('Reconnected to {}'.format(name))
+
+	async def poll(self, task, name, read):
+		'''
+		Calls read(name) until the experiment ends. Sleeps shortly when read
+		returns False (no data) and reconnects when the inlet is lost.
+		'''
+		while self.running:
+			t = time.perf_counter()
+			self.enter(task)
+			try:
+				has_data = read(name)
+			except LostError:
+				await self.reconnect(name)
+				continue
+
+			if has_data:
+				self.latency.record(task, time.perf_counter() - t)
+				self.data_event.set()
+				await asyncio.sleep(0)
+			else:
+				await asyncio.sleep(self.idle_sleep)
+
+	def read_markers(self, name):
+		''' Handles all pending markers, returns True if there were any '''
+		markers, timestamps = self.inlets[name].pull_chunk(timeout=0.0)
+		for marker, marker_ts in zip(markers, timestamps):
+			if self.handle_marker(name, marker, marker_ts):
+				self.trial_ready = True
+		return len(markers) > 0
+
+	async def classify(self):
+		''' Classifies every window (or trial) as soon as it is in the buffer '''
+		loop = asyncio.get_running_loop()
+		while self.running:
+			try:
+				await asyncio.wait_for(self.data_event.wait(), timeout=0.5)
+			except asyncio.TimeoutError:
+				continue
+			self.data_event.clear()
+
+			while self.trial_ready or self.window_ready():
+				self.trial_ready = False
+				t_ready = time.perf_counter()
+				self.enter('classify')
+				window = self.next_window()
+				result = await loop.run_in_executor(self.executor, self.classify_window, window)
+				self.latency.record('classify', time.perf_counter() - t_ready)
+				await self.results_queue.put((result, t_ready))
+
+	async def publish_results(self):
+		''' Sends the results to the UI '''
+		while self.running or not self.results_queue.empty():
+			try:
+				result, t_ready = await asyncio.wait_for(self.results_queue.get(), timeout=0.5)
+			except asyncio.TimeoutError:
+				continue
+			t = time.perf_counter()
+			self.enter('publish')
+			self.publish(result)
+			self.latency.record('publish', time.perf_counter() - t)
+			self.latency.record('window_to_command', time.perf_counter() - t_ready)
+
+	async def run_async(self, warmup=False):
+		self.timed('load_config', self.load_config, 'config.yml')
+		t = time.time()
+		await self.connect_streams_async()
+		self.startup_times += [('connect_streams (waiting)', time.time() - t)]
+		self.initialize(warmup)
+
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.data_event = asyncio.Event()
+		self.results_queue = asyncio.Queue()
+
+		self.start_profiler()
+		self.running = True
+		tasks = [self.poll('ingest_eeg', self.eeg_inlet_name, self.read_chunk),
+				 self.poll('markers', 'UiOutput', self.read_markers),
+				 self.classify(),
+				 self.publish_results()]
+		if self.frame_timeline is not None:
+			tasks += [self.poll('ingest_frames', self.frames_inlet_name, self.read_frames)]
+		await asyncio.gather(*tasks)
+
+		self.executor.shutdown()
+		self.shutdown()
+		self.latency.report()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='SSVEP decoder (asyncio)')
+	parser.add_argument('--warmup', action='store_true',
+						help='Classify a dummy window before the experiment starts')
+	args = parser.parse_args()
+
+	print('Starting decoder...')
+	dec = AsyncDecoder()
+	try:
+		asyncio.run(dec.run_async(warmup=args.warmup))
+	finally:
+		dec.close_streams()
@@ -0,0 +1,185 @@
+import queue
+import threading
+
+import numpy as np
+
+from classifiers.CCAClassifier import CCAClassifier
+
+
+class AdaptiveCCAClassifier(CCAClassifier):
+	''' CCA classifier that learns a spatial filter per class during the session.
+
+	Windows labelled with their intended class (e.g. the direction of the
+	target in the closed loop game) are passed to adapt(). For every class
+	two covariances are kept up to date with rank-one updates (one outer
+	product per sample, with exponential forgetting):
+		total:   sum x x^T         (all samples of the window)
+		signal:  sum x' x'^T       (window projected on the reference signals)
+	The spatial filter of the class is the direction w that maximizes
+	w^T signal w / w^T total w, which is the correlation the filtered EEG
+	reaches with the reference signals. Nothing is refitted from stored
+	windows.
+
+	The score of a class is a mix of the normal CCA correlation and the
+	correlation of the spatially filtered window with the reference
+	signals. The weight of the latter grows with the number of labelled
+	windows of that class.
+
+	Updates run on a background thread that publishes a new model when
+	done; adapt() only puts the window on a queue, so classification is
+	never blocked. The published model includes the covariances it was
+	computed from and is never changed afterwards, so snapshot() saves it
+	without waiting for the worker. rollback() is queued to the worker,
+	which restores the snapshot between two updates.
+	'''
+
+	def __init__(self, forgetting=0.99, regularization=1e-3, warmup_windows=20,
+				 max_queue=50, max_snapshots=10):
+		super().__init__()
+
+		self.forgetting = forgetting
+		self.regularization = regularization
+		self.warmup_windows = warmup_windows
+		self.max_snapshots = max_snapshots
+
+		self.model = None  # Published model and its covariances, only replaced as a whole
+		self.snapshots = []
+		self.n_dropped = 0
+
+		self.lock = threading.Lock()  # Held by the worker during an update
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.thread = None
+
+	def __getstate__(self):
+		# The copy doesn't adapt, only the model is sent (e.g. to worker processes)
+		state = super().__getstate__()
+		state['max_queue'] = self.queue.maxsize
+		for name in ['lock', 'queue', 'thread']:
+			del state[name]
+		return state
+
+	def __setstate__(self, state):
+		max_queue = state.pop('max_queue')
+		super().__setstate__(state)
+		self.lock = threading.Lock()
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.thread = None
+
+	def prepare(self, frequencies, samplerate, max_sample_length, class_names=None):
+		n_classes_before = self.n_classes
+		super().prepare(frequencies, samplerate, max_sample_length, class_names)
+
+		# Only start over if the classes changed, not when frequencies are corrected
+		if self.model is None or n_classes_before != self.n_classes:
+			with self.lock:
+				self.model = None
+
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._run, name='Adaptation', daemon=True)
+			self.thread.start()
+
+	def adapt(self, window, label):
+		'''
+		Queue a window [samples x channels] labelled with its class index for
+		the next update. Returns False if the queue is full and the window is
+		dropped.
+		'''
+		try:
+			self.queue.put_nowait(('adapt', (np.array(window, dtype=np.float64), label)))
+			return True
+		except queue.Full:
+			self.n_dropped += 1
+			return False
+
+	def stop(self):
+		''' Stops the adaptation thread after the queued windows are processed '''
+		if self.thread is None:
+			return
+		self.queue.put(('stop', None))
+		self.thread.join()
+		self.thread = None
+
+	def snapshot(self):
+		''' Save the current model, returns the number of saved snapshots '''
+		if self.model is not None:
+			self.snapshots = (self.snapshots + [self.model])[-self.max_snapshots:]
+		return len(self.snapshots)
+
+	def rollback(self, index=-1):
+		'''
+		Restore a saved model (by default the last snapshot) after the
+		windows queued before. Returns False if there is no snapshot.
+		'''
+		if len(self.snapshots) == 0:
+			return False
+		self.queue.put(('rollback', self.snapshots[index]))
+		return True
+
+	def _run(self):
+		while True:
+			command, args = self.queue.get()
+			if command == 'stop':
+				break
+			with self.lock:
+				if command == 'rollback':
+					self.model = args
+				else:
+					self._update(*args)
+
+	def _update(self, window, label):
+		n_channels = window.shape[1]
+		if self.model is None:
+			stats = {'total': np.zeros((self.n_classes, n_channels, n_channels)),
+					 'signal': np.zeros((self.n_classes, n_channels, n_channels)),
+					 'count': np.zeros(self.n_classes)}
+		else:
+			# The published covariances are copied, snapshots may refer to them
+			stats = {key: value.copy() for key, value in self.model['stats'].items()}
+
+		x = window - window.mean(axis=0)
+		projection = np.matmul(self.reference_basis(window.shape[0])[label].T, x)  # [6 x ch]
+
+		stats['total'][label] = self.forgetting * stats['total'][label] + np.matmul(x.T, x)
+		stats['signal'][label] = self.forgetting * stats['signal'][label] + \
+								 np.matmul(projection.T, projection)
+		stats['count'][label] = self.forgetting * stats['count'][label] + 1
+
+		filters = self.model['filters'].copy() if self.model is not None \
+				  else np.zeros((n_channels, self.n_classes))
+		filters[:, label] = self._spatial_filter(stats['total'][label], stats['signal'][label])
+
+		weights = stats['count'] / (stats['count'] + self.warmup_windows)
+
+		# Publish as a new object, so scores() never sees a half updated model
+		self.model = {'filters': filters, 'weights': weights, 'stats': stats}
+
+	def _spatial_filter(self, total, signal):
+		''' Solves signal w = l total w for the largest l '''
+		n_channels = total.shape[0]
+		total = total + self.regularization * np.trace(total) / n_channels * np.eye(n_channels)
+		chol = np.linalg.cholesky(total)
+		chol_inv = np.linalg.inv(chol)
+		_, vectors = np.linalg.eigh(chol_inv @ signal @ chol_inv.T)
+		w = chol_inv.T @ vectors[:, -1]
+		return w / np.linalg.norm(w)
+
+	def scores(self, windows):
+		cca_scores = super().scores(windows)
+
+		model = self.model
+		if model is None:
+			return cca_scores
+
+		windows = np.asarray(windows, dtype=np.float64)
+		n_samples = windows.shape[1]
+		windows = windows - windows.mean(axis=1, keepdims=True)
+
+		# Spatially filtered windows [w x n x classes] and their correlation
+		# with the reference signals of the same class
+		filtered = np.matmul(windows, model['filters'])
+		projection = np.einsum('knh,wnk->wkh', self.reference_basis(n_samples), filtered)
+		norm = np.linalg.norm(filtered, axis=1)
+		filter_scores = np.linalg.norm(projection, axis=2) / np.where(norm > 0, norm, 1)
+
+		weights = model['weights']
+		return (1 - weights) * cca_scores + weights * filter_scores
@@ -1,12 +1,13 @@
-import bisect
+import threading
 from math import ceil, floor
 
 import numpy as np
-import mne
-from sklearn.cross_decomposition import CCA
+# mne is slow to import, so it is imported by the method that uses it
 
+from classifiers.Classifier import Classifier
 
-class CCAClassifier():
+
+class CCAClassifier(Classifier):
 	''' CCA classifyer maximizes correlation between two
 	canonical variates, which are linear combinations of
 	the original two sets of variables.
@@ -15,50 +16,103 @@ class CCAClassifier():
 
 	This classifier compares the given sample of size
 	[sample x channels] with each pre-set frequency and
-	its harmonics. The pre-set frequency that correlates
-	the most with the sample is selected and returned.	
-	
+	its harmonics. The score of each class is the canonical
+	correlation with its pre-set frequency.	
+
+	Windows can have any length. The reference signals are generated for
+	max_sample_length samples and extended when a longer window comes in
+	(see extend_references). The reference basis of a window length is
+	derived from running sums of the references (see whitening), so a
+	new length only costs the samples since the closest checkpoint.
 	'''
 
 	def __init__(self):
-		self.max_sample_length = None
-		self.fs = None
+		super().__init__()
 
 		self.n_harmonics = 3
+		self.checkpoint_interval = 250  # Samples between saved reference Gram sums
+		self.max_cached_lengths = 256
+
+		self.references = None  # [capacity x classes*2*harmonics], valid up to n_generated
+		self.reference_rate = None  # Samplerate of the references
+		self.n_generated = 0
+		self.gram_checkpoints = []  # (sum r r^T [k x 2h x 2h], sum r [k x 2h]) per checkpoint_interval samples
+		self.basis_cache = {}  # window length: whitening [k x 2h x 2h]
+		# Guards the references, checkpoints and cache, which are also used by the
+		# adaptation thread. Reentrant, whitening extends the references
+		self.reference_lock = threading.RLock()
+
+	def __getstate__(self):
+		# Locks can't be pickled, e.g. to send the classifier to worker processes
+		state = self.__dict__.copy()
+		del state['reference_lock']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.reference_lock = threading.RLock()
+
+	def prepare(self, frequencies, samplerate, max_sample_length, class_names=None):
+		super().prepare(frequencies, samplerate, max_sample_length, class_names)
+		self.generateSignals(frequencies, max_sample_length, samplerate)
 
 	def generateSignals(self, freqList, max_sample_length, samplerate):
 		self.fs = samplerate
 		self.max_sample_length = max_sample_length
 
-		segment_time = np.array([x/samplerate for x in range(0, max_sample_length)])
-
-		self.freqClasses = freqList
-		
-		self.generatedSignals = np.zeros((len(self.freqClasses), max_sample_length, 6))
-		for i, freq in enumerate(self.freqClasses):
-			self.generatedSignals[i,:,0] = np.sin(np.pi*2*freq*segment_time)
-			self.generatedSignals[i,:,1] = np.cos(np.pi*2*freq*segment_time)
-			self.generatedSignals[i,:,2] = np.sin(np.pi*2*freq*segment_time*2)
-			self.generatedSignals[i,:,3] = np.cos(np.pi*2*freq*segment_time*2)
-			self.generatedSignals[i,:,4] = np.sin(np.pi*2*freq*segment_time*3)
-			self.generatedSignals[i,:,5] = np.cos(np.pi*2*freq*segment_time*3)
-
-	def locate_pos(self, available_freqs, target_freq):
+		# Built first and swapped in at once, so other threads never see the
+		# references of one configuration with the checkpoints of another
+		freqs = list(freqList)
+		n_refs = 2*self.n_harmonics
+		references = reference_signals(freqs, samplerate, self.n_harmonics, 0, max_sample_length)
+		gram_checkpoints = [(np.zeros((len(freqs), n_refs, n_refs)), np.zeros((len(freqs), n_refs)))]
+		with self.reference_lock:
+			self.freqClasses = freqs
+			self.reference_rate = samplerate
+			self.references = references
+			self.n_generated = max_sample_length
+			self.gram_checkpoints = gram_checkpoints
+			self.basis_cache = {}
+
+	@property
+	def generatedSignals(self):
+		''' The generated reference signals [classes x samples x 2*harmonics] (a view) '''
+		with self.reference_lock:
+			return self.references[:self.n_generated] \
+					   .reshape(self.n_generated, len(self.freqClasses), -1).transpose(1, 0, 2)
+
+	def extend_references(self, n_samples):
 		'''
-		Locates the closest value to the right for given target. 
-		TODO Check if why vars are called freqs and not timestamps (which are supplied as args)
+		Makes sure at least n_samples of the reference signals are generated.
+		Only the missing samples are computed, continuing from the phase of
+		every class and harmonic at the last generated sample, and written
+		after the existing ones. Capacity grows by doubling, so the
+		references are reallocated only a few times per session.
+
+		Samples already generated are never written again, so views on
+		them stay valid.
 		'''
-		pos = bisect.bisect_right(available_freqs, target_freq)
-		if pos == 0:
-			return 0
-		if pos == len(available_freqs):
-			return len(available_freqs)-1
-		if abs(available_freqs[pos]-target_freq) < abs(available_freqs[pos-1]-target_freq):
-			return pos
-		else:
-			return pos-1
+		with self.reference_lock:
+			start = self.n_generated
+			if n_samples <= start:
+				return
+			if n_samples > self.references.shape[0]:
+				references = np.empty((max(n_samples, 2*self.references.shape[0]), self.references.shape[1]))
+				references[:start] = self.references[:start]
+				self.references = references
+
+			self.references[start:n_samples] = reference_signals(
+				self.freqClasses, self.reference_rate, self.n_harmonics, start, n_samples)
+			self.n_generated = n_samples
+
+	def stacked_references(self, n_samples):
+		''' The first n_samples of the references [n_samples x classes*2*harmonics] (a view) '''
+		with self.reference_lock:
+			self.extend_references(n_samples)
+			return self.references[:n_samples]
 
 	def preprocess(self, data):
+		import mne
 
 		##### BANDPASS FILTER #####
 		cutoff_low = max(2, floor(min(self.freqClasses)) - 2) #-+ to prevent filter cutting of the actual frequency
@@ -75,55 +129,139 @@ class CCAClassifier():
 
 		return data
 
-	def classify_chunk(self, eeg_data, conf_level=0):
-		class_label = {
-			0: 'top',
-			1: 'left',
-			2: 'down',
-			3: 'right',
-			4: 'nothing'}	
+	def _gram_sums(self, start, stop):
+		''' Sums of r r^T and r over the reference samples start:stop, per class '''
+		refs = self.stacked_references(stop)[start:stop].reshape(stop - start, len(self.freqClasses), -1)
+		return np.einsum('nki,nkj->kij', refs, refs), refs.sum(axis=0)
 
-		eeg_data = np.array(eeg_data)
+	def whitening(self, n_samples):
+		'''
+		Matrices W [classes x 2h x 2h] such that the centered first n_samples
+		of each class's references times W are an orthonormal basis of
+		them. Directions of (near) rank deficient references are zero, like
+		in orthonormal_basis.
+
+		With the centered Gram matrix C = sum r r^T - n mean mean^T = V L V^T,
+		W = V L^-1/2. The sums are saved every checkpoint_interval samples,
+		so a new window length only adds the samples since the checkpoint
+		before it. W is cached per window length.
+		'''
+		with self.reference_lock:
+			return self._whitening(n_samples)
+
+	def _whitening(self, n_samples):
+		whitening = self.basis_cache.get(n_samples)
+		if whitening is not None:
+			return whitening
+
+		checkpoint = n_samples // self.checkpoint_interval
+		while len(self.gram_checkpoints) <= checkpoint:
+			n = len(self.gram_checkpoints) * self.checkpoint_interval
+			gram, total = self._gram_sums(n - self.checkpoint_interval, n)
+			last_gram, last_total = self.gram_checkpoints[-1]
+			self.gram_checkpoints.append((last_gram + gram, last_total + total))
+
+		gram, total = self.gram_checkpoints[checkpoint]
+		if n_samples > checkpoint * self.checkpoint_interval:
+			extra_gram, extra_total = self._gram_sums(checkpoint * self.checkpoint_interval, n_samples)
+			gram, total = gram + extra_gram, total + extra_total
+		centered = gram - np.einsum('ki,kj->kij', total, total) / n_samples
+
+		values, vectors = np.linalg.eigh(centered)
+		rank_mask = values > 1e-12 * np.max(values, axis=-1, keepdims=True)
+		scale = np.where(rank_mask, 1 / np.sqrt(np.where(rank_mask, values, 1)), 0)
+		whitening = vectors * scale[:, np.newaxis, :]
+
+		if len(self.basis_cache) >= self.max_cached_lengths:
+			self.basis_cache = {}
+		self.basis_cache[n_samples] = whitening
+		return whitening
+
+	def reference_basis(self, n_samples):
+		''' Orthonormal basis [classes x n_samples x 2*harmonics] of the centered references of each class '''
+		refs, whitening = self.references_and_whitening(n_samples)
+		refs = refs.reshape(n_samples, len(self.freqClasses), -1).transpose(1, 0, 2)
+		return np.matmul(refs - refs.mean(axis=1, keepdims=True), whitening)
+
+	def references_and_whitening(self, n_samples):
+		''' stacked_references and whitening of the same configuration, also during prepare '''
+		with self.reference_lock:
+			return self.stacked_references(n_samples), self._whitening(n_samples)
+
+	def scores(self, windows):
+		'''
+		Canonical correlations [windows x classes] between every window and
+		the reference signals of every class, for all windows at once.
+
+		The canonical correlations of X and Y are the singular values of
+		Qx^T Qy, with Qx and Qy orthonormal bases of the centered X and Y.
+		The largest one is the correlation found by CCA with 1 component.
+
+		Qx is computed once per window and shared by all classes. Qy is
+		never formed: the columns of Qx are centered, so
+		Qx^T Qy = Qx^T (R - mean) W = (Qx^T R) W, with R the raw references
+		of all classes side by side and W their whitening (see whitening).
+		A single matrix product with a view on R gives Qx^T R for every
+		class, only the small [channels x 2*harmonics] products are then
+		handled per class, which keeps the cost of many classes (e.g. a 40
+		target speller) low.
+
+		Windows of any length are scored on all their samples.
+		'''
+		windows = np.asarray(windows, dtype=np.float64)
 
 		## Preprocess
-		# data = self.preprocess(eeg_data)
-
-		## Classify
-		cca_result = []
-		# Compare generatedSignals with each FrequencyClass
-		for i in range(len(self.freqClasses)):
-			# Select correct sample length (i.e. check if it doesn't exceed max sample length)
-			sampleLen = min(eeg_data.shape[0], len(self.generatedSignals[i]))
-			ccaInput = eeg_data[:sampleLen, :]
-
-			# Fit to correct format:
-			ccaGen = self.generatedSignals[i, :sampleLen, :]
-
-			# Create CCA-Object
-			cca = CCA(n_components=1) # TODO: Check if declaring earlier is quicker
-									   # 	   and repeated fitting doesn't influence data
-			
-			# Train model with data:
-			cca.fit(ccaInput, ccaGen)
-
-			# Transform data:
-			res_sample, res_gensig = cca.transform(ccaInput, ccaGen)
-
-			# Add Correlation coefficient of transformed data to list:
-			cca_result.append(np.corrcoef(res_sample.T, res_gensig.T)[0][1])
-
-		# Returns the class with the highest correlation:
-		maxCorrel = max(cca_result) 
-		classId = cca_result.index(maxCorrel)
-		print('\t {0:<5s} {1:d}  [{2:.2f}] // \t [{3:.2f},   {4:.2f},   {5:.2f},   {6:.2f}]'\
-			  .format(class_label[classId], classId, maxCorrel, 
-			  		  cca_result[0], cca_result[1], cca_result[2], cca_result[3]))
-		print(conf_level)
-		if maxCorrel <= conf_level: # Empirically determine this boundary
-			#TODO: Make the confidence level based on the difference between all the correlations
-			classId = 4 # = NOTHING
-
-		return classId
+		# windows = np.stack([self.preprocess(window) for window in windows])
+
+		n_samples = windows.shape[1]
+		q_eeg = orthonormal_basis(windows - windows.mean(axis=1, keepdims=True))  # [w x n x ch]
+		refs, whitening = self.references_and_whitening(n_samples)  # [n x k*2h], [k x 2h x 2h]
+
+		# [w x ch x n] @ [n x k*2h] -> [w x k x ch x 2h]
+		cross = np.matmul(q_eeg.transpose(0, 2, 1), refs)
+		cross = cross.reshape(windows.shape[0], -1, len(whitening), 2*self.n_harmonics).transpose(0, 2, 1, 3)
+
+		return largest_singular_value(np.matmul(cross, whitening))
+
+
+def reference_signals(frequencies, samplerate, n_harmonics, start, stop):
+	'''
+	Samples start:stop of the sin and cos of every harmonic of every
+	frequency [stop-start x frequencies*2*harmonics]. Columns per
+	frequency: sin, cos of harmonic 1, then 2, ...
+	'''
+	# Angle per sample [frequencies x harmonics], the start phase is wrapped to
+	# keep the precision of long sessions
+	harmonics = np.arange(1, n_harmonics + 1)
+	step = 2*np.pi / samplerate * np.multiply.outer(frequencies, harmonics)
+	phase = np.mod(step * start, 2*np.pi)
+	angles = phase + np.multiply.outer(np.arange(stop - start), step)  # [n x k x h]
+	return np.stack([np.sin(angles), np.cos(angles)], axis=-1).reshape(stop - start, -1)
+
+
+def orthonormal_basis(x, tol=1e-10):
+	'''
+	Orthonormal basis of the columns of each matrix in the stack x
+	[... x samples x columns]. Directions of (near) rank deficient matrices,
+	e.g. flat channels, are set to zero.
+	'''
+	u, s, _ = np.linalg.svd(x, full_matrices=False)
+	rank_mask = s > tol * np.max(s, axis=-1, keepdims=True)
+	return u * rank_mask[..., np.newaxis, :]
+
+
+def largest_singular_value(m):
+	'''
+	Largest singular value of each matrix in the stack m [... x rows x
+	columns], from the eigenvalues of the smallest Gram matrix (cheaper
+	than a full SVD for many small matrices).
+	'''
+	if m.shape[-2] < m.shape[-1]:
+		gram = np.matmul(m, m.swapaxes(-1, -2))
+	else:
+		gram = np.matmul(m.swapaxes(-1, -2), m)
+	return np.sqrt(np.maximum(np.linalg.eigvalsh(gram)[..., -1], 0))
+
 
 if __name__ == "__main__":
 	import matplotlib.pyplot as plt
@@ -141,7 +279,7 @@ if __name__ == "__main__":
 
 	data = np.random.rand(n_samp, n_chs)
 
-	cca.generateSignals(freq_list, max_sample_length, fs)
+	cca.prepare(freq_list, fs, max_sample_length)
 	result = cca.classify_chunk(data)
 	
 
@@ -0,0 +1,100 @@
+import bisect
+from importlib import import_module
+
+import numpy as np
+
+# Returned instead of a class index if no class reaches the confidence level
+NOTHING = -1
+
+# Name in config.yml (classifier: name) -> 'module:Class'. Classifiers are
+# imported when selected, so unused classifiers don't slow down startup.
+CLASSIFIERS = {
+	'cca': 'classifiers.CCAClassifier:CCAClassifier',
+	'adaptive_cca': 'classifiers.AdaptiveCCAClassifier:AdaptiveCCAClassifier',
+}
+
+
+def register_classifier(name, path):
+	''' Make a classifier selectable from the config, path is 'module:Class' '''
+	CLASSIFIERS[name] = path
+
+
+def get_classifier(name, **kwargs):
+	''' Returns a new instance of the classifier registered as name '''
+	if name not in CLASSIFIERS:
+		raise ValueError('Unknown classifier: {}. Choose from {}'.format(name, list(CLASSIFIERS)))
+	module_name, class_name = CLASSIFIERS[name].split(':')
+	return getattr(import_module(module_name), class_name)(**kwargs)
+
+
+class Classifier():
+	''' Interface for all SSVEP classifiers.
+
+	prepare() is called once with the stimulus frequencies (and again if
+	they change). scores() returns a score per class for a stack of
+	windows [windows x samples x channels] and predict_batch() turns the
+	scores into class indices. Implementations only have to provide
+	prepare and scores, but should score the whole stack at once where
+	possible.
+
+	The number of classes is the number of frequencies given to prepare.
+	'''
+
+	def __init__(self):
+		self.frequencies = []
+		self.class_names = []
+		self.fs = None
+		self.max_sample_length = None
+
+	@property
+	def n_classes(self):
+		return len(self.frequencies)
+
+	def prepare(self, frequencies, samplerate, max_sample_length, class_names=None):
+		self.frequencies = list(frequencies)
+		self.fs = samplerate
+		self.max_sample_length = max_sample_length
+		self.class_names = list(class_names) if class_names is not None \
+						   else [str(i) for i in range(len(self.frequencies))]
+
+	def scores(self, windows):
+		''' Returns the scores [windows x classes] for windows [windows x samples x channels] '''
+		raise NotImplementedError
+
+	def predict_batch(self, windows, conf_level=0):
+		'''
+		Returns the class index with the highest score for every window and
+		the scores. Windows where the highest score does not exceed
+		conf_level are classified as NOTHING.
+		'''
+		scores = self.scores(windows)
+		predictions = np.argmax(scores, axis=1)
+		predictions[np.max(scores, axis=1) <= conf_level] = NOTHING
+		return predictions, scores
+
+	def classify_chunk(self, eeg_data, conf_level=0):
+		''' Classifies a single window [samples x channels] and prints the scores '''
+		predictions, scores = self.predict_batch(np.asarray(eeg_data)[np.newaxis], conf_level)
+		classId, scores = int(predictions[0]), scores[0]
+
+		best = int(np.argmax(scores))
+		print('\t {0:<5s} {1:d}  [{2:.2f}] // \t [{3}]'
+			  .format(self.class_names[classId] if classId != NOTHING else 'nothing', classId,
+			  		  scores[best], ',   '.join('{:.2f}'.format(s) for s in scores)))
+
+		return classId
+
+	def locate_pos(self, available_freqs, target_freq):
+		'''
+		Locates the closest value to the right for given target.
+		TODO Check if why vars are called freqs and not timestamps (which are supplied as args)
+		'''
+		pos = bisect.bisect_right(available_freqs, target_freq)
+		if pos == 0:
+			return 0
+		if pos == len(available_freqs):
+			return len(available_freqs)-1
+		if abs(available_freqs[pos]-target_freq) < abs(available_freqs[pos-1]-target_freq):
+			return pos
+		else:
+			return pos-1
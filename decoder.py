@@ -4,15 +4,29 @@ You may use, distribute and modify this code under the
 terms of the MIT license.
 '''
 import time
+IMPORT_START = time.time()
+
+import argparse
+import os
 import sys
 import yaml
 
 import numpy as np
-import pandas as pd
-from pylsl import StreamInlet, StreamOutlet, StreamInfo, resolve_streams
-
-from classifiers.CCAClassifier import CCAClassifier
-
+from pylsl import StreamInlet, StreamOutlet, StreamInfo, resolve_streams, local_clock
+
+from classifiers.Classifier import get_classifier, NOTHING
+from stimuli.StimulusEngine import effective_frequency
+from stimuli.FrameTelemetry import FrameTimeline
+from stimuli.TargetLayout import TargetLayout
+from experiment.LabelSequence import LabelSequence
+from preprocessing.ArtifactDetector import ArtifactDetector
+from recording.SessionRecorder import SessionRecorder
+from streams.StreamClock import StreamClock
+from streams.InletMonitor import InletMonitor
+from profiling.Profiler import Profiler
+from streams.SharedRing import RingInlet, RingOutlet, open_inlet, shared_memory_streams
+
+IMPORT_TIME = time.time() - IMPORT_START
 
 class Decoder():
 	''' Handles all data streams between amplifiers, UI and classifier'''
@@ -21,17 +35,22 @@ class Decoder():
 		# Experiment
 		self.closed_loop = None
 		self.eeg_channels = []
-		self.freqList = []
+		self.targets = None  # TargetLayout: frequency and name of every class
 
 		# LSL Streams
 		self.inlets = {}
 		self.outlets = {}
 		self.inlet_names = []
 		self.outlet_names = []
+		self.clock_sync = True
+		self.clocks = {}  # Inlet name: StreamClock
+		self.shared_memory_streams = []  # Streams to/from the UI that don't use LSL
 
 		# Data buffers
 		self.timestamp_buffer = []
 		self.data_buffer = []
+		self.artifact_buffer = []  # Artifact flag per sample in data_buffer
+		self.buffer_start_index = 0  # Sample index of data_buffer[0]
 		
 		# Classifier
 		self.classification_start = None
@@ -41,14 +60,54 @@ class Decoder():
 		self.confidence_level = 0
 
 		self.classifier = None
+		self.classifier_name = 'cca'
+		self.classifier_options = {}
 		self.max_sample_length = None
 		self.labels = []
 		self.results = []
 		self.trial_count = 0
 
+		# Artifact rejection
+		self.artifact_config = None
+		self.artifact_detector = None
+		self.max_bad_fraction = 1
+		self.n_windows = 0
+		self.n_skipped = 0
+
+		# Backlog and sample loss of the EEG inlet
+		self.inlet_monitor = None
+		self.gap_tolerance = 10  # Sample periods between timestamps that count as a gap
+		self.max_backlog = 0.5  # Seconds the classification may lag behind the data
+		self.n_steps_skipped = 0
+
+		# Profiling (config: profiling, or SIGUSR1)
+		self.profiler = None
+		self.profile_on_start = False
+
+		# Frame telemetry
+		self.frames_inlet_name = None
+		self.frame_timeline = None
+		self.max_dropped_frames = 0
+		self.max_frame_delay = 0.5  # Seconds to wait for the frames of a window
+		self.n_skipped_dropped = 0
+
+		# Online adaptation (closed loop game)
+		self.adaptive = False
+		self.snapshot_interval = 50
+		self.n_adapted = 0
+		self.player_pos = None
+		self.target_pos = None
+
+		# Recording
+		self.recording_config = None
+		self.recorder = None
+
 		# Commands
 		self.command_mapping = None
 
+		# Startup timing: [(stage, seconds)]
+		self.startup_times = [('imports', IMPORT_TIME)]
+
 	def load_config(self, filename):
 		''' Loads all data from the config file and saves in the instance
 		variables. '''
@@ -59,57 +118,128 @@ class Decoder():
 				pass
 
 		self.closed_loop = conf['experiment']['closedLoop']
-		self.command_mapping = conf['experiment']['commandMapping']
+		self.targets = TargetLayout(conf)
+		self.command_mapping = self.targets.command_mapping
 		self.eeg_channels = conf['experiment']['channels']
 		
-		self.freqList = conf['experiment']['stimulusFrequencies']
+		self.classifier_name = conf['classifier'].get('name', self.classifier_name)
+		self.classifier_options = conf['classifier'].get('options') or {}
+		self.snapshot_interval = (conf['classifier'].get('adaptation') or {}).get('snapshotInterval',
+																				 self.snapshot_interval)
 		self.max_sample_length = conf['classifier']['maxSampleLength']
 
 		config_inlets = conf['streams']['decoder']['inlet_names']
 		self.eeg_inlet_name = config_inlets['eeg']
+		self.frames_inlet_name = config_inlets.get('frames')
 		self.inlet_names = [config_inlets[inlet_type] for inlet_type in config_inlets]  # TODO: Change inlet loading such that you can choose the eeg stream dynamically
 		self.outlet_names = conf['streams']['decoder']['outlet_names']
+		self.clock_sync = bool(conf['streams']['decoder'].get('clockSync', self.clock_sync))
+		self.shared_memory_streams = shared_memory_streams(conf)
+		self.gap_tolerance = conf['streams']['decoder'].get('gapTolerance', self.gap_tolerance)
+		self.max_backlog = conf['streams']['decoder'].get('maxBacklog', self.max_backlog)
 		
 		# Uncomment to include classification labels
 		if 'labelFile' in conf['classifier']:
 			self.labels = self.read_label_file(conf['classifier']['labelFile'])
 
 		self.confidence_level = conf['classifier']['confidence_level']
+		self.max_dropped_frames = conf['classifier'].get('maxDroppedFrames', 0)
+
+		if conf['classifier'].get('artifacts', {}).get('enabled'):
+			self.artifact_config = conf['classifier']['artifacts']
+
+		if conf.get('recording', {}).get('enabled'):
+			self.recording_config = conf['recording']
+
+		self.profiler = Profiler.from_config('decoder', conf)
+		self.profile_on_start = bool(conf.get('profiling', {}).get('enabled'))
 
 		self.monitor_refresh_rate = conf['ui']['monitorRefreshRate']
+		self.measured_refresh_rate = self.monitor_refresh_rate
+		self.stimulus_mode = conf['ui'].get('stimulusMode', 'flash')
 
 
 	def read_label_file(self, lab_file):
 		'''
-		Read all labels in the supplied label file and saves it for later
-		classifier performance measurements.
+		Returns the labels in the supplied label file for later classifier
+		performance measurements. The file is only read when the labels are
+		first used (see experiment/LabelSequence.py).
 		'''
+		return LabelSequence(lab_file)
 
-		try:
-			with open(lab_file, 'r') as f:
-				labels = f.read()
-			return [int(l) for l in list(labels)]
-		except Exception as err:
-			raise
+	def get_frequencies(self):
+		'''
+		Returns the stimulus frequencies (Hz) as actually shown by the UI. The UI
+		codes the frequencies in frames of the configured refresh rate, so they
+		are rounded to the frame grid and scaled by the measured refresh rate.
+		'''
+		scale = self.measured_refresh_rate / self.monitor_refresh_rate
+		return [effective_frequency(f, self.monitor_refresh_rate, self.stimulus_mode) * scale
+				for f in self.targets.frequencies]
 
 	def initialize_classifier(self, on_stream):
 		'''
-		Initialize and save a Canonical correlation analysis classifier in self and
-		calculated the standards signal that the classifier compares the EEG data
-		with.
-
-		TODO: Change to classifier.initialize() -> More modular
+		Initialize and save the classifier selected in the config (see
+		classifiers/Classifier.py for the available classifiers) and prepare
+		it for the stimulus frequencies. There is a class per frequency.
 		'''
 
-		freqs = list(self.freqList.values())
 		samplerate = self.inlets[on_stream].info().nominal_srate()
-		freqs = [self.monitor_refresh_rate/f for f in freqs]
+		freqs = self.get_frequencies()
 		print(freqs)
 
-		self.classifier = CCAClassifier()
-		# TODO: freqs should be given as Hz, currently given as "draw every x frames"
-		# 		3 = fps/3 = 60/3 = 20 Hz
-		self.classifier.generateSignals(freqs, self.max_sample_length, samplerate)
+		self.classifier = get_classifier(self.classifier_name, **self.classifier_options)
+		self.classifier.prepare(freqs, samplerate, self.max_sample_length,
+								class_names=self.targets.names)
+
+		# Classifiers that can learn from labelled windows are adapted in closed loop
+		self.adaptive = bool(self.closed_loop) and hasattr(self.classifier, 'adapt')
+
+	def update_refresh_rate(self, refresh_rate):
+		'''
+		Uses the refresh rate measured from the flip timestamps of the UI
+		(frame telemetry, see update_frame_rate). The classifier is only
+		prepared again, which regenerates its reference signals and clears
+		its caches, when the stimulus frequencies change by 0.01 Hz or more.
+		'''
+		self.measured_refresh_rate = refresh_rate
+		frequencies = self.get_frequencies()
+		if np.array_equal(np.round(frequencies, 2), np.round(self.classifier.frequencies, 2)):
+			return
+		self.classifier.prepare(frequencies, self.classifier.fs, self.max_sample_length,
+								class_names=self.classifier.class_names)
+
+	def initialize_artifact_detector(self, on_stream):
+		'''
+		Initialize the streaming artifact detector on the selected channels.
+		Has to be called after select_channels.
+		'''
+		if self.artifact_config is None:
+			return
+
+		samplerate = self.inlets[on_stream].info().nominal_srate()
+		self.artifact_detector = ArtifactDetector(samplerate,
+			window_size=self.artifact_config.get('windowSize', 0.2),
+			max_variance=self.artifact_config.get('maxVariance'),
+			max_peak_to_peak=self.artifact_config.get('maxPeakToPeak'),
+			flatline=self.artifact_config.get('flatline'))
+		self.max_bad_fraction = self.artifact_config.get('maxBadFraction', 0.2)
+
+	def start_recording(self):
+		'''
+		Starts the background recorder that saves all ingested samples,
+		markers and classification results in a new session directory.
+		'''
+		if self.recording_config is None:
+			return
+
+		directory = os.path.join(self.recording_config.get('directory', 'recordings'),
+								 time.strftime('session_%Y%m%d_%H%M%S'))
+		self.recorder = SessionRecorder(directory,
+			segment_size=self.recording_config.get('segmentSize', 10000),
+			max_queue=self.recording_config.get('maxQueue', 1000))
+		self.recorder.start()
+		print('Recording session to {}'.format(directory))
 
 	def connect_streams(self):
 		'''
@@ -122,13 +252,13 @@ class Decoder():
 		# For selecting streamInlets, see also: resolve_byprop, resolve_pypred
 		'''
 
-		stream_name = self.outlet_names[0]
-		info = StreamInfo(stream_name, 'Commands', 1, 0, 'int8', 'com1')
-		self.outlets[stream_name] = StreamOutlet(info)
+		self.create_outlets()
 		
 		# StreamInlets
 		print('Searching for stream inlets...')
 		while len(self.inlets) < len(self.inlet_names):
+			self.open_shared_memory_inlets()
+
 			# Iterate over LSL streams and connect them to an outlet
 			streams = resolve_streams(wait_time=1.0)
 			for stream in streams:
@@ -144,38 +274,188 @@ class Decoder():
 				.format(list(self.inlets.keys()), list(self.outlets.keys())))
 
 
-	def read_chunk(self, stream_name, max_chunk_samples=1024):
+	def create_outlets(self):
+		''' Creates the outlet for the commands, over LSL or shared memory (see config: streams) '''
+		stream_name = self.outlet_names[0]
+		if stream_name in self.shared_memory_streams:
+			self.outlets[stream_name] = RingOutlet(stream_name, 'int8')
+		else:
+			info = StreamInfo(stream_name, 'Commands', 1, 0, 'int8', 'com1')
+			self.outlets[stream_name] = StreamOutlet(info)
+
+	def close_streams(self):
+		''' Closes the shared memory streams, which removes the blocks of the outlets '''
+		for streams in [self.outlets, self.inlets]:
+			for name in [name for name, stream in streams.items() if isinstance(stream, (RingOutlet, RingInlet))]:
+				streams.pop(name).close()
+
+	def open_shared_memory_inlets(self):
+		''' Connects the inlets that use shared memory, if their outlet exists '''
+		for name in self.shared_memory_streams:
+			if name in self.inlet_names and name not in self.inlets:
+				inlet = open_inlet(name)
+				if inlet is not None:
+					self.inlets[name] = inlet
+
+	def initialize_inlet_monitor(self, on_stream):
+		''' Starts tracking the backlog and sample loss of the EEG inlet '''
+		samplerate = self.inlets[on_stream].info().nominal_srate()
+		self.inlet_monitor = InletMonitor(self.inlets[on_stream], samplerate,
+										  gap_tolerance=self.gap_tolerance)
+
+	def start_clocks(self):
+		'''
+		Starts a StreamClock for every inlet, so markers, frame telemetry and
+		EEG samples share the decoder's clock. EEG timestamps are dejittered.
+		'''
+		if not self.clock_sync:
+			return
+		for name, inlet in self.inlets.items():
+			srate = inlet.info().nominal_srate() if name == self.eeg_inlet_name else 0
+			self.clocks[name] = StreamClock(inlet, nominal_srate=srate)
+			self.clocks[name].start()
+
+	def correct_timestamps(self, stream_name, timestamps):
+		''' Returns the timestamps of stream_name on the decoder's clock '''
+		if stream_name not in self.clocks:
+			return timestamps
+		return self.clocks[stream_name].correct(timestamps).tolist()
+
+	def locate(self, timestamp):
+		'''
+		Returns the position in the data buffer of the sample closest to
+		timestamp. Computed from the sample index if the EEG clock is fitted,
+		otherwise searched for in the timestamp buffer.
+		'''
+		clock = self.clocks.get(self.eeg_inlet_name)
+		if clock is not None and clock.fitted:
+			pos = int(round(clock.index_at(timestamp))) - self.buffer_start_index
+			return min(max(pos, 0), len(self.timestamp_buffer) - 1)
+		return self.classifier.locate_pos(self.timestamp_buffer, timestamp)
+
+	def read_chunk(self, stream_name):
 		'''
-		Reads a chunk of given size from StreamInlet
+		Reads all available samples from the EEG StreamInlet (see
+		streams/InletMonitor.py for the pull size and gap detection).
 		Chunk is a list of samples and timestamp a list of timestamps
 		'''
-		chunk, timestamps = self.inlets[stream_name].pull_chunk(timeout=0.0, max_samples=max_chunk_samples)
+		chunk, timestamps, gaps = self.inlet_monitor.pull_chunk()
 
 		if len(chunk) == 0:
 			return False
+		received = None
+		if len(gaps) > 0:
+			chunk, timestamps, received = self.fill_gaps(chunk, timestamps, gaps)
+		timestamps = self.correct_timestamps(stream_name, timestamps)
 		self.data_buffer.extend(chunk)
 		self.timestamp_buffer.extend(timestamps)
+		if self.artifact_detector is not None:
+			flags = self.artifact_detector.update(np.array(chunk)[:, self.ch_idx])
+			self.artifact_buffer.extend(flags)
+		if self.recorder is not None:
+			if received is not None:
+				# Only record the samples that were actually received
+				chunk = [sample for sample, r in zip(chunk, received) if r]
+				timestamps = [t for t, r in zip(timestamps, received) if r]
+			self.recorder.write('eeg', chunk, timestamps)
 
 		return True
+
+	def fill_gaps(self, chunk, timestamps, gaps):
+		'''
+		Fills the samples lost in gaps (see InletMonitor) with the last
+		sample before the gap, so positions in the buffer stay in step with
+		the sample index and time. Filled stretches are flat, so the
+		artifact detector (if enabled) flags windows that contain them.
+		Returns the filled chunk and timestamps and whether each sample was
+		received.
+		'''
+		srate = self.inlet_monitor.nominal_srate
+		filled, filled_timestamps, received = [], [], []
+		start = 0
+		for pos, n_lost in gaps:
+			filled += chunk[start:pos]
+			filled_timestamps += timestamps[start:pos]
+			received += [True] * (pos - start)
+
+			previous = filled[-1] if len(filled) > 0 else \
+					   self.data_buffer[-1] if len(self.data_buffer) > 0 else chunk[pos]
+			filled += [previous] * n_lost
+			filled_timestamps += [timestamps[pos] - (n_lost - i)/srate for i in range(n_lost)]
+			received += [False] * n_lost
+			start = pos
+
+		filled += chunk[start:]
+		filled_timestamps += timestamps[start:]
+		received += [True] * (len(chunk) - start)
+		print('Lost {} EEG samples'.format(sum(n_lost for _, n_lost in gaps)))
+		return filled, filled_timestamps, received
 	
+	def read_frames(self, stream_name):
+		'''
+		Reads the flip times and dropped frame flags published by the UI.
+		Returns True if there were new frames.
+		'''
+		chunk, timestamps = self.inlets[stream_name].pull_chunk(timeout=0.0)
+		if len(chunk) == 0:
+			return False
+		if stream_name in self.clocks:
+			# Flip times are sent as a channel, on the clock of the UI
+			offset = self.clocks[stream_name].offset
+			chunk = [[sample[0] + offset] + list(sample[1:]) for sample in chunk]
+			timestamps = self.correct_timestamps(stream_name, timestamps)
+		self.frame_timeline.extend(chunk)
+		if self.recorder is not None:
+			self.recorder.write('frames', chunk, timestamps)
+
+		return True
+
+	def update_frame_rate(self, frame_rate):
+		'''
+		Uses the frame rate of the UI measured during a window (see
+		next_window) for the reference signals, smoothed over windows.
+		'''
+		if frame_rate is None:
+			return
+		self.update_refresh_rate(0.9*self.measured_refresh_rate + 0.1*frame_rate)
+
 	def check_markers(self, stream_name):
 		'''
 		Reads markers stream from UI and handles incoming markers. Used to determine
 		the start and end of trials or the experiment
 		'''
 		marker, marker_ts = self.inlets[stream_name].pull_sample(timeout=0.0)
-		if marker is not None:
-			if marker[0] == 'trial_start':
-				self.classification_start = marker_ts
-			elif marker[0] == 'trial_end' and self.classification_start is not None:
-				self.classification_stop = marker_ts
-				self.trial_count += 1
-				return True
-			elif marker[0] == 'experiment_start':
-				self.classification_start = marker_ts
-			elif marker[0] == 'experiment_end':
-				self.running = False
-				print('Experiment finished.')
+		if marker is None:
+			return False
+		return self.handle_marker(stream_name, marker, marker_ts)
+
+	def handle_marker(self, stream_name, marker, marker_ts):
+		'''
+		Handles a single marker. Returns True if it completes a trial.
+		'''
+		marker_ts = self.correct_timestamps(stream_name, [marker_ts])[0]
+		if self.recorder is not None:
+			self.recorder.write('markers', [marker], [marker_ts])
+		if marker[0] == 'trial_start':
+			self.classification_start = marker_ts
+		elif marker[0] == 'trial_end' and self.classification_start is not None:
+			self.classification_stop = marker_ts
+			self.trial_count += 1
+			return True
+		elif marker[0] == 'experiment_start':
+			self.classification_start = marker_ts
+		elif marker[0] == 'experiment_end':
+			self.running = False
+			print('Experiment finished.')
+		elif marker[0].startswith('playerposition_'):
+			self.player_pos = [float(p) for p in marker[0].split('_')[1:3]]
+		elif marker[0].startswith('targetposition_'):
+			self.target_pos = [float(p) for p in marker[0].split('_')[1:3]]
+		elif marker[0] == 'rollback' and self.adaptive:
+			if self.classifier.rollback():
+				print('Rolling the classifier back to the last snapshot.')
+			else:
+				print('No classifier snapshot to roll back to yet.')
 		return False
 
 	def get_score(self):
@@ -213,91 +493,342 @@ class Decoder():
 
 		Removes all data from buffer (in class, not the LSL buffer) before
 		classification end. Data is still saved if LabRecorder is used.
+
+		If artifact rejection is enabled, windows with more than
+		max_bad_fraction flagged samples are not classified and return the
+		'nothing' class. In closed loop, windows with fewer flagged samples
+		require a proportionally higher confidence level. In closed loop,
+		windows with more than max_dropped_frames dropped frames are not
+		classified either, if the UI publishes frame telemetry. Trials in
+		open loop are always classified.
 		
 		Class mapping: See config
 
 		'''
+		return self.classify_window(self.next_window())
+
+	def next_window(self):
+		'''
+		Selects the data of the next window and moves on to the next window
+		(or trial). Only touches the buffers, the classification itself is
+		done by classify_window.
+
+		Returns a dict with the data, the confidence level and the window
+		times, or with the class to return if the window is skipped. The
+		frame rate of the UI during the window is measured here as well, so
+		classify_window doesn't read the frame telemetry, which is extended
+		by another thread in the async decoder.
+		'''
+		if self.closed_loop:
+			self.skip_backlog()
+
 		# Determine data slice in buffer
-		pos_start = self.classifier.locate_pos(self.timestamp_buffer,
-											   self.classification_start)
+		pos_start = self.locate(self.classification_start)
 		if self.closed_loop:
-			pos_step = self.classifier.locate_pos(self.timestamp_buffer,
-												  self.classification_start + self.step_size)
-			pos_stop = self.classifier.locate_pos(self.timestamp_buffer,
-												  self.classification_start + self.window_size)
+			pos_step = self.locate(self.classification_start + self.step_size)
+			pos_stop = self.locate(self.classification_start + self.window_size)
 		else:
-			pos_stop = self.classifier.locate_pos(self.timestamp_buffer,
-												  self.classification_stop)
-
-		# Select that part
-		data = np.array(self.data_buffer[pos_start:pos_stop])[:, self.ch_idx]
+			pos_stop = self.locate(self.classification_stop)
+
+		window = {'conf_level': self.confidence_level if self.closed_loop else 0,
+				  't_start': self.timestamp_buffer[pos_start],
+				  't_stop': self.timestamp_buffer[pos_stop],
+				  'frame_rate': None,
+				  'skipped': None}
+
+		# Check for artifacts and dropped frames before spending time on the classifier
+		bad_fraction = 0
+		if self.artifact_detector is not None:
+			bad_fraction = ArtifactDetector.bad_fraction(self.artifact_buffer[pos_start:pos_stop])
+		n_dropped = 0
+		if self.frame_timeline is not None:
+			window['frame_rate'] = self.frame_timeline.frame_rate(window['t_start'], window['t_stop'])
+			if self.closed_loop:
+				n_dropped = self.frame_timeline.dropped_frames(window['t_start'], window['t_stop'])
+		self.n_windows += 1
+
+		if bad_fraction > self.max_bad_fraction:
+			self.n_skipped += 1
+			window['skipped'] = self.command_mapping['nothing']
+		elif n_dropped > self.max_dropped_frames:
+			self.n_skipped_dropped += 1
+			window['skipped'] = self.command_mapping['nothing']
+		else:
+			if self.closed_loop:
+				window['conf_level'] += (1 - window['conf_level']) * bad_fraction
 
-		# Classify
-		conf_lvl = self.confidence_level if self.closed_loop else 0
-		classId = self.classifier.classify_chunk(data, conf_level=conf_lvl)
+			# Select that part
+			window['data'] = np.array(self.data_buffer[pos_start:pos_stop])[:, self.ch_idx]
 
 		if self.closed_loop:
 			# Move window
 			self.classification_start += self.step_size
 
+			self.buffer_start_index += pos_step
 			self.data_buffer = self.data_buffer[pos_step:]
 			self.timestamp_buffer = self.timestamp_buffer[pos_step:]
+			self.artifact_buffer = self.artifact_buffer[pos_step:]
 		else:
 			# Reset buffers
+			self.buffer_start_index += len(self.data_buffer)
 			self.data_buffer = []
 			self.timestamp_buffer = []
+			self.artifact_buffer = []
+
+		return window
+
+	def skip_backlog(self):
+		'''
+		If the classification lags more than max_backlog seconds behind the
+		newest data (e.g. after a slow classification), skips the steps in
+		between so the next window is the newest full window. Commands stay
+		up to date at the cost of some windows, instead of lagging further
+		and further behind.
+		'''
+		if self.max_backlog is None:
+			return
+		behind = self.timestamp_buffer[-1] - (self.classification_start + self.window_size)
+		if behind <= self.max_backlog:
+			return
+
+		n_steps = int(behind // self.step_size)
+		self.classification_start += n_steps * self.step_size
+		self.n_steps_skipped += n_steps
+
+		pos = self.locate(self.classification_start)
+		self.buffer_start_index += pos
+		self.data_buffer = self.data_buffer[pos:]
+		self.timestamp_buffer = self.timestamp_buffer[pos:]
+		self.artifact_buffer = self.artifact_buffer[pos:]
+
+	def classify_window(self, window):
+		''' Classifies a window selected by next_window and returns the class '''
+		if window['skipped'] is not None:
+			return window['skipped']
+
+		self.update_frame_rate(window['frame_rate'])
+
+		# Classify
+		classId = self.classifier.classify_chunk(window['data'], conf_level=window['conf_level'])
+		if classId == NOTHING:
+			classId = self.command_mapping['nothing']
+
+		if self.adaptive:
+			self.adapt_classifier(window['data'])
 
 		return classId
 
+	def intended_class(self):
+		'''
+		Returns the class index of the direction the player has to move in to
+		reach the target in the closed loop game (along the axis with the
+		largest distance), or None if unknown.
+		'''
+		if self.player_pos is None or self.target_pos is None:
+			return None
+		dx = self.target_pos[0] - self.player_pos[0]
+		dy = self.target_pos[1] - self.player_pos[1]
+		if abs(dx) > abs(dy):
+			direction = 'right' if dx > 0 else 'left'
+		else:
+			direction = 'top' if dy > 0 else 'bottom'
+		if direction not in self.classifier.class_names:
+			return None
+		return self.classifier.class_names.index(direction)
+
+	def adapt_classifier(self, data):
+		'''
+		Hands the window, labelled with the direction of the target, to the
+		classifier. The update itself runs in the background. Snapshots of
+		the model are saved every snapshot_interval windows, so a 'rollback'
+		marker can undo bad adaptation.
+		'''
+		label = self.intended_class()
+		if label is None:
+			return
+		if self.classifier.adapt(data, label):
+			self.n_adapted += 1
+			if self.n_adapted % self.snapshot_interval == 0:
+				self.classifier.snapshot()
+
+	def get_skip_rate(self):
+		'''Prints the fraction of windows skipped because of artifacts, dropped frames or backlog'''
+		if self.inlet_monitor is not None:
+			print('EEG inlet: {}'.format(self.inlet_monitor.report()))
+		if self.n_windows == 0:
+			return
+		if self.n_steps_skipped > 0:
+			print('Skipped {} steps ({:.1f}s) because the classification fell behind'
+				  .format(self.n_steps_skipped, self.n_steps_skipped * self.step_size))
+		if self.artifact_detector is not None:
+			print('Skipped {}/{} windows ({:.0f}%) due to artifacts'
+				  .format(self.n_skipped, self.n_windows, self.n_skipped/self.n_windows*100))
+		if self.frame_timeline is not None and self.closed_loop:
+			print('Skipped {}/{} windows ({:.0f}%) due to dropped frames'
+				  .format(self.n_skipped_dropped, self.n_windows, self.n_skipped_dropped/self.n_windows*100))
+
+	def warmup_classifier(self):
+		'''
+		Classifies a dummy window, so the first real window doesn't pay for
+		loading and initializing the libraries used by the classifier.
+		'''
+		n_samples = int(self.window_size * self.classifier.fs)
+		data = np.random.randn(n_samples, len(self.ch_idx))
+		self.classifier.classify_chunk(data)
+
+	def timed(self, stage, func, *args):
+		''' Runs func(*args) and saves its duration for the startup report '''
+		t = time.time()
+		result = func(*args)
+		self.startup_times += [(stage, time.time() - t)]
+		return result
+
+	def report_startup(self):
+		''' Prints the duration of each startup stage '''
+		print('\nStartup times:')
+		for stage, seconds in self.startup_times:
+			print('\t{:<24s} {:.2f}s'.format(stage, seconds))
+		print('\t{:<24s} {:.2f}s'.format('total', time.time() - IMPORT_START))
+
 	def send_commands(self, stream, result):
 		''' Sends the classification results to the LSL server '''
 		self.outlets[stream].push_sample([result])
 
-	def run(self):
-		self.load_config('config.yml')
-
-		self.connect_streams()
-		self.initialize_classifier(self.eeg_inlet_name)
+	def setup(self, warmup=False):
+		''' Loads the config, connects all streams and prepares all stages '''
+		self.timed('load_config', self.load_config, 'config.yml')
+		self.timed('connect_streams (waiting)', self.connect_streams)
+		self.initialize(warmup)
+
+	def initialize(self, warmup=False):
+		''' Prepares all stages once the streams are connected '''
+		self.start_clocks()
+		self.initialize_inlet_monitor(self.eeg_inlet_name)
+		self.timed('initialize_classifier', self.initialize_classifier, self.eeg_inlet_name)
 		self.select_channels(self.eeg_inlet_name)
+		self.timed('initialize_artifacts', self.initialize_artifact_detector, self.eeg_inlet_name)
+		if self.frames_inlet_name is not None:
+			self.frame_timeline = FrameTimeline(max_frames=int(10*self.monitor_refresh_rate))
+		if warmup:
+			self.timed('warmup', self.warmup_classifier)
+		self.start_recording()
+		self.report_startup()
+
+	def start_profiler(self):
+		''' Profiles the calling loop now (if enabled) or when SIGUSR1 is received '''
+		if self.profiler is None:
+			return
+		self.profiler.install_signal()
+		if self.profile_on_start:
+			self.profiler.start()
+
+	def enter(self, stage):
+		''' Tags the profile samples with the pipeline stage '''
+		if self.profiler is not None:
+			self.profiler.enter(stage)
+
+	def window_ready(self):
+		'''
+		Returns True if a full window is in the buffer in closed loop, i.e.
+		the classification start exists and a full window size is present.
+		With frame telemetry, the frames up to the end of the window have to
+		be received too (or be more than max_frame_delay seconds late), so
+		its dropped frames are known.
+		'''
+		if not (self.closed_loop and
+				self.classification_start and
+				len(self.timestamp_buffer) > 0):
+			return False
+		t_stop = self.classification_start + self.window_size
+		if t_stop > self.timestamp_buffer[-1]:
+			return False
+		return self.frame_timeline is None or \
+			   self.frame_timeline.covers(t_stop) or \
+			   self.timestamp_buffer[-1] - t_stop > self.max_frame_delay
+
+	def publish(self, result):
+		''' Saves the result and sends it to the UI '''
+		self.results.extend([result])
+		if self.recorder is not None:
+			self.recorder.write('results', [[result]], [local_clock()])
+		self.send_commands('UiInput', result)
+		if not self.closed_loop:
+			print('True|Pred - {}|{}'.format(self.labels[self.trial_count-1], 
+									   		 result))
+												# self.results[self.trial_count-1]))
+
+	def shutdown(self):
+		''' Stops all background stages and prints the session summary '''
+		self.get_skip_rate()
+
+		for clock in self.clocks.values():
+			clock.stop()
+
+		if self.profiler is not None:
+			self.profiler.stop()
+
+		if self.recorder is not None:
+			self.recorder.stop()
+
+		if self.adaptive:
+			self.classifier.stop()
+			print('Adapted classifier on {} windows'.format(self.n_adapted))
+
+		self.close_streams()
 
+		if len(self.labels) > 0 and not self.closed_loop:
+			try:
+				self.get_score()
+			except Exception:
+				pass
+
+	def run(self, warmup=False):
+		self.setup(warmup)
+
+		self.start_profiler()
 		self.running = True
 		while self.running:
 			t = time.time()
+			self.enter('read_eeg')
 			has_received_data = self.read_chunk(self.eeg_inlet_name)
 			
 			if not has_received_data:
+				self.enter('idle')
 				continue
+
+			if self.frame_timeline is not None:
+				self.enter('read_frames')
+				self.read_frames(self.frames_inlet_name)
 			# print('{0:d} - {1:.3f} // {2:.3f}'.format(len(self.data_buffer), min(self.timestamp_buffer), max(self.timestamp_buffer)))
 			
-			if (self.check_markers('UiOutput')) or \
-			   		(self.closed_loop and
-			    	 self.classification_start and
-			    	 self.classification_start + self.window_size <= self.timestamp_buffer[-1]):
+			self.enter('markers')
+			if self.check_markers('UiOutput') or self.window_ready():
 			    # Returns True is complete trial is in buffer or exp is a closed loop,
 			    # classification start index exists and a full window size is present
+				self.enter('classify')
 				result = self.apply_model()
-				self.results.extend([result])
-				self.send_commands('UiInput', result)
-				if not self.closed_loop:
-					print('True|Pred - {}|{}'.format(self.labels[self.trial_count-1], 
-											   		 result))
-														# self.results[self.trial_count-1]))
+				self.enter('publish')
+				self.publish(result)
 
 			passed_time = time.time() - t
 			if passed_time > 0.1:
 				print('Time per loop: {0:.2f}s'.format(passed_time))
 
-		if any(self.labels) and not self.closed_loop:
-			try:
-				self.get_score()
-			except Exception:
-				pass
+		self.shutdown()
 
 if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='SSVEP decoder')
+	parser.add_argument('--warmup', action='store_true',
+						help='Classify a dummy window before the experiment starts')
+	args = parser.parse_args()
+
 	print('Starting decoder...')
 	# input_stream_name = 'gtec_outlet'  # TODO: Get input_stream_name from config
 	dec = Decoder()
-	dec.run()
+	try:
+		dec.run(warmup=args.warmup)
+	finally:
+		dec.close_streams()
 	# dec.run(eeg_stream_name=input_stream_name)
 
 
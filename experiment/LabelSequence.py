@@ -0,0 +1,123 @@
+'''
+Copyright (C) 2019 Maarten Ottenhoff.
+You may use, distribute and modify this code under the
+terms of the MIT license.
+
+Label (target) sequences of labeled experiments: generation with
+counterbalancing constraints and the label file formats.
+
+File formats (chosen by extension when writing, detected when reading):
+	.npy	binary, a 1D integer array
+	other	text, labels separated by newlines, commas or whitespace
+Text files without any separator are read as the old format with one
+single digit label per character (e.g. '0330132212').
+'''
+import re
+
+import numpy as np
+
+
+def generate_sequence(n_classes, n_trials, no_repeats=True, balanced=True, seed=None):
+	'''
+	Returns a random sequence of n_trials class indices (np.ndarray).
+
+	no_repeats:	the same class never appears twice in a row.
+	balanced:	every class is followed equally often by every (other)
+				class. The sequence is made of Eulerian circuits through
+				the graph of all allowed transitions, so within every
+				n_classes*(n_classes-1) trials (n_classes^2 with repeats)
+				each transition occurs exactly once and each class
+				equally often. Only the last, incomplete circuit is not
+				fully balanced.
+	If not balanced, the class counts are balanced instead (no_repeats
+	then only approximately balances them).
+
+	The same seed gives the same sequence.
+	'''
+	rng = np.random.RandomState(seed)
+	if n_classes < 2 and no_repeats:
+		raise ValueError('At least 2 classes are needed to avoid repeats')
+	if n_trials <= 0:
+		return np.empty(0, dtype=np.int64)
+
+	if balanced:
+		sequence = [int(rng.randint(n_classes))]
+		while len(sequence) < n_trials:
+			sequence += _eulerian_circuit(n_classes, sequence[-1], no_repeats, rng)[1:]
+		return np.array(sequence[:n_trials], dtype=np.int64)
+
+	if no_repeats:
+		# Every step moves 1..n_classes-1 classes further (modulo n_classes)
+		steps = rng.randint(1, n_classes, size=n_trials - 1)
+		start = rng.randint(n_classes)
+		return np.concatenate([[start], start + np.cumsum(steps)]) % n_classes
+
+	reps = -(-n_trials // n_classes)
+	return rng.permutation(np.tile(np.arange(n_classes), reps))[:n_trials]
+
+
+def _eulerian_circuit(n_classes, start, no_repeats, rng):
+	''' Random circuit from start through every allowed transition once (Hierholzer) '''
+	remaining = [[b for b in rng.permutation(n_classes) if not (no_repeats and a == b)]
+				 for a in range(n_classes)]
+	stack, circuit = [start], []
+	while stack:
+		node = stack[-1]
+		if remaining[node]:
+			stack.append(int(remaining[node].pop()))
+		else:
+			circuit.append(stack.pop())
+	return circuit[::-1]
+
+
+def transition_counts(sequence, n_classes):
+	''' Matrix [from x to] with the number of times each transition occurs '''
+	counts = np.zeros((n_classes, n_classes), dtype=np.int64)
+	sequence = np.asarray(sequence)
+	np.add.at(counts, (sequence[:-1], sequence[1:]), 1)
+	return counts
+
+
+def write_labels(filename, labels):
+	''' Writes labels as .npy (binary) or as text with one label per line '''
+	labels = np.asarray(labels, dtype=np.int64)
+	if filename.endswith('.npy'):
+		np.save(filename, labels)
+	else:
+		with open(filename, 'w') as f:
+			f.write('\n'.join(str(label) for label in labels) + '\n')
+
+
+def read_labels(filename):
+	''' Reads a label file in any of the formats above, returns np.ndarray '''
+	if filename.endswith('.npy'):
+		return np.load(filename, mmap_mode='r')
+
+	with open(filename, 'r') as f:
+		text = f.read().strip()
+	if re.search(r'[\s,;]', text) is None:
+		return np.array([int(label) for label in text], dtype=np.int64)  # Old format
+	return np.array([int(label) for label in re.split(r'[\s,;]+', text)], dtype=np.int64)
+
+
+class LabelSequence():
+	''' The labels of a label file, read on first use instead of at startup '''
+
+	def __init__(self, filename):
+		self.filename = filename
+		self._labels = None
+
+	@property
+	def labels(self):
+		if self._labels is None:
+			self._labels = read_labels(self.filename)
+		return self._labels
+
+	def __len__(self):
+		return len(self.labels)
+
+	def __getitem__(self, index):
+		return int(self.labels[index])
+
+	def __iter__(self):
+		return (int(label) for label in self.labels)
@@ -3,20 +3,47 @@
 Created on Thu Oct  3 12:52:19 2019
 
 @author: Maarten
+
+Generates the label sequence of a labeled experiment, see
+experiment/LabelSequence.py for the constraints and file formats.
+
+Usage:
+	python generate_labels.py                    # 20 trials of the targets in config.yml
+	python generate_labels.py --trials 2000 --seed 1 --output labels.npy
 """
-from random import shuffle
+import argparse
+import time
+
+import numpy as np
+import yaml
 
-classes = [0, 1, 2, 3]
-reps = 5
+from experiment.LabelSequence import generate_sequence, transition_counts, write_labels
+from stimuli.TargetLayout import TargetLayout
 
-labels = [str(i) for i in classes]
-labels = labels*reps
-shuffle(labels)
-labels = ''.join(labels)
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate a counterbalanced label sequence')
+	parser.add_argument('--classes', type=int, help='Number of classes (default: number of targets in config.yml)')
+	parser.add_argument('--trials', type=int, default=20)
+	parser.add_argument('--seed', type=int, help='Same seed, same sequence')
+	parser.add_argument('--output', default='labels.txt', help='.npy for binary, otherwise text')
+	parser.add_argument('--allow-repeats', action='store_true', help='Allow the same class twice in a row')
+	parser.add_argument('--unbalanced', action='store_true',
+						help="Don't balance the transitions between classes, only the class counts")
+	args = parser.parse_args()
 
-f = open('labels.txt', 'w+')
-f.write(labels)
-f.close()
+	n_classes = args.classes
+	if n_classes is None:
+		with open('config.yml', 'r') as file:
+			n_classes = len(TargetLayout(yaml.safe_load(file)))
 
+	t = time.time()
+	labels = generate_sequence(n_classes, args.trials, no_repeats=not args.allow_repeats,
+							   balanced=not args.unbalanced, seed=args.seed)
+	write_labels(args.output, labels)
 
-#f = open("labels.txt", "r").read()
+	transitions = transition_counts(labels, n_classes)
+	off_diagonal = transitions[~np.eye(n_classes, dtype=bool)]
+	print('{} labels of {} classes written to {} in {:.3f}s'.format(len(labels), n_classes, args.output, time.time() - t))
+	print('Class counts: {}-{}, transitions between classes: {}-{}, repeats: {}'
+		  .format(np.bincount(labels, minlength=n_classes).min(), np.bincount(labels, minlength=n_classes).max(),
+				  off_diagonal.min(), off_diagonal.max(), np.trace(transitions)))
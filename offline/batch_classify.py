@@ -0,0 +1,123 @@
+'''
+Copyright (C) 2019 Maarten Ottenhoff.
+You may use, distribute and modify this code under the
+terms of the MIT license.
+
+Offline (re-)classification of all overlapping windows of a recording.
+
+Usage (from the repository root):
+	python -m offline.batch_classify <session directory> [--jobs 4]
+	python -m offline.batch_classify --benchmark
+'''
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from classifiers.Classifier import get_classifier
+
+
+def sliding_windows(recording, window_samples, step_samples):
+	'''
+	Returns a read-only view [windows x window_samples x channels] of all
+	windows of recording [samples x channels], starting every step_samples.
+	No data is copied.
+	'''
+	recording = np.asarray(recording)
+	n_windows = (recording.shape[0] - window_samples) // step_samples + 1
+	if n_windows <= 0:
+		return np.empty((0, window_samples, recording.shape[1]), dtype=recording.dtype)
+	return as_strided(recording,
+					  shape=(n_windows, window_samples, recording.shape[1]),
+					  strides=(recording.strides[0]*step_samples,) + recording.strides,
+					  writeable=False)
+
+
+# State of the worker processes, set once per worker by _init_worker
+_worker = {}
+
+
+def _init_worker(classifier, recording, window_samples, step_samples, conf_level):
+	_worker['classifier'] = classifier
+	_worker['windows'] = sliding_windows(recording, window_samples, step_samples)
+	_worker['conf_level'] = conf_level
+
+
+def _classify_range(start, stop):
+	return _worker['classifier'].predict_batch(_worker['windows'][start:stop],
+											   _worker['conf_level'])
+
+
+def classify_recording(classifier, recording, window_samples, step_samples,
+					   chunk_size=256, n_jobs=1, conf_level=0):
+	'''
+	Classifies all windows of recording [samples x channels] with a prepared
+	classifier. Windows are scored chunk_size at a time to bound memory,
+	spread over n_jobs processes if n_jobs > 1.
+	Returns the predictions [windows] and scores [windows x classes].
+	'''
+	windows = sliding_windows(recording, window_samples, step_samples)
+	ranges = [(start, min(start + chunk_size, len(windows)))
+			  for start in range(0, len(windows), chunk_size)]
+	if len(ranges) == 0:
+		return np.empty(0, dtype=int), np.empty((0, classifier.n_classes))
+
+	if n_jobs > 1:
+		with multiprocessing.Pool(n_jobs, initializer=_init_worker,
+								  initargs=(classifier, recording, window_samples,
+								  			step_samples, conf_level)) as pool:
+			results = pool.starmap(_classify_range, ranges)
+	else:
+		results = [classifier.predict_batch(windows[start:stop], conf_level)
+				   for start, stop in ranges]
+
+	return (np.concatenate([predictions for predictions, _ in results]),
+			np.concatenate([scores for _, scores in results]))
+
+
+def benchmark(classifier, n_windows=10000, window_samples=500, n_channels=8,
+			  step_samples=50, n_jobs=1):
+	''' Prints the number of windows per second on random data '''
+	n_samples = (n_windows - 1) * step_samples + window_samples
+	recording = np.random.randn(n_samples, n_channels)
+	t = time.time()
+	classify_recording(classifier, recording, window_samples, step_samples, n_jobs=n_jobs)
+	passed_time = time.time() - t
+	print('{} windows in {:.2f}s: {:.0f} windows/s'.format(n_windows, passed_time,
+														   n_windows/passed_time))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Offline classification of all windows of a recording')
+	parser.add_argument('session', nargs='?', help='Directory recorded by the decoder (see config: recording)')
+	parser.add_argument('--classifier', default='cca')
+	parser.add_argument('--frequencies', type=float, nargs='+', default=[10, 7.5, 5.45, 4.29])
+	parser.add_argument('--srate', type=float, default=500)
+	parser.add_argument('--window', type=float, default=1, help='Window size (s)')
+	parser.add_argument('--step', type=float, default=0.1, help='Step size (s)')
+	parser.add_argument('--channels', type=int, nargs='+', help='Indices of the channels to use (default: all)')
+	parser.add_argument('--jobs', type=int, default=1)
+	parser.add_argument('--benchmark', action='store_true')
+	args = parser.parse_args()
+
+	window_samples = int(args.window * args.srate)
+	step_samples = int(args.step * args.srate)
+
+	classifier = get_classifier(args.classifier)
+	classifier.prepare(args.frequencies, args.srate, window_samples)
+
+	if args.benchmark:
+		benchmark(classifier, window_samples=window_samples, step_samples=step_samples,
+				  n_jobs=args.jobs)
+	else:
+		from recording.SessionRecorder import read_stream
+		recording, timestamps = read_stream(args.session, 'eeg')
+		if args.channels is not None:
+			recording = recording[:, args.channels]
+		predictions, scores = classify_recording(classifier, recording, window_samples,
+												 step_samples, n_jobs=args.jobs)
+		print('Classified {} windows: {}'.format(len(predictions),
+												 np.bincount(predictions[predictions >= 0],
+												 			 minlength=classifier.n_classes)))
@@ -0,0 +1,85 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Per-sample artifact flags (bitmask)
+CLEAN = 0
+VARIANCE = 1
+PEAK_TO_PEAK = 2
+FLATLINE = 4
+
+
+class ArtifactDetector():
+	''' Streaming artifact detector that flags every incoming sample.
+
+	Each sample is judged on the trailing window of window_size seconds
+	(over the selected channels). A sample is flagged when, on any channel,
+	the rolling variance exceeds max_variance, the peak-to-peak amplitude
+	exceeds max_peak_to_peak (blinks, motion) or the peak-to-peak amplitude
+	drops below flatline (loose or saturated electrode).
+
+	Only the last window_size-1 samples are kept between chunks, so the
+	cost per chunk scales with the chunk size and not the buffer size.
+	'''
+
+	def __init__(self, samplerate, window_size=0.2, max_variance=None,
+				 max_peak_to_peak=None, flatline=None):
+		self.window_samples = max(2, int(round(window_size * samplerate)))
+		self.max_variance = max_variance
+		self.max_peak_to_peak = max_peak_to_peak
+		self.flatline = flatline
+
+		self.tail = None
+
+	def reset(self):
+		''' Forget the history, e.g. after a gap in the stream '''
+		self.tail = None
+
+	def update(self, chunk):
+		'''
+		Returns an array with a flag for each sample in chunk [samples x channels].
+		Samples without a complete trailing window are marked CLEAN.
+		'''
+		chunk = np.asarray(chunk, dtype=np.float64)
+		if chunk.ndim == 1:
+			chunk = chunk[:, np.newaxis]
+		n_new = chunk.shape[0]
+		flags = np.zeros(n_new, dtype=np.uint8)
+		if n_new == 0:
+			return flags
+
+		data = chunk if self.tail is None else np.concatenate((self.tail, chunk))
+		data = np.ascontiguousarray(data)
+		self.tail = data[-(self.window_samples-1):]
+
+		n_windows = min(n_new, data.shape[0] - self.window_samples + 1)
+		if n_windows <= 0:
+			return flags
+
+		# Trailing window of each of the last n_windows samples, without copying
+		data = data[-(n_windows + self.window_samples - 1):]
+		n_ch = data.shape[1]
+		windows = as_strided(data,
+							 shape=(n_windows, self.window_samples, n_ch),
+							 strides=(data.strides[0], data.strides[0], data.strides[1]),
+							 writeable=False)
+
+		window_flags = flags[-n_windows:]
+		if self.max_variance is not None:
+			variance = windows.var(axis=1)
+			window_flags[(variance > self.max_variance).any(axis=1)] |= VARIANCE
+		if self.max_peak_to_peak is not None or self.flatline is not None:
+			ptp = windows.max(axis=1) - windows.min(axis=1)
+			if self.max_peak_to_peak is not None:
+				window_flags[(ptp > self.max_peak_to_peak).any(axis=1)] |= PEAK_TO_PEAK
+			if self.flatline is not None:
+				window_flags[(ptp < self.flatline).any(axis=1)] |= FLATLINE
+
+		return flags
+
+	@staticmethod
+	def bad_fraction(flags):
+		''' Fraction of flagged samples in the given flags '''
+		flags = np.asarray(flags)
+		if flags.size == 0:
+			return 0.0
+		return float(np.count_nonzero(flags)) / flags.size
@@ -0,0 +1,165 @@
+'''
+Copyright (C) 2019 Maarten Ottenhoff.
+You may use, distribute and modify this code under the
+terms of the MIT license.
+
+Profiles the decoder loop or the UI frame loop for a limited time during a
+live session. Started from the config (profiling: enabled) or by sending
+the process SIGUSR1 (SIGBREAK, i.e. Ctrl+Break, on Windows).
+
+Modes:
+	sampled:		a background thread takes the Python stack of every thread
+					each `interval` seconds. The loop itself is not
+					instrumented, so this is cheap enough to leave on in
+					pilot sessions.
+	deterministic:	every Python and C function call of the loop thread is
+					timed with sys.setprofile. Exact, but slows the loop
+					down, so keep the duration short.
+
+The loops tag what they are doing with enter(stage), which is prefixed to
+the stacks of the loop thread, so the profile is split by pipeline stage.
+
+The result is written as folded stacks ('stage;file:function;... count'),
+with samples (sampled) or microseconds (deterministic) as count. These
+can be opened with flamegraph.pl, inferno, speedscope (speedscope.app)
+and most other flame graph viewers.
+'''
+import os
+import signal
+import sys
+import threading
+import time
+
+SAMPLED = 'sampled'
+DETERMINISTIC = 'deterministic'
+
+MODES = (SAMPLED, DETERMINISTIC)
+
+
+def _frame_name(code):
+	return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler():
+	''' See the module docstring. One profile at a time, start() is ignored while running '''
+
+	def __init__(self, name, mode=SAMPLED, duration=30, interval=0.005, directory='profiles'):
+		if mode not in MODES:
+			raise ValueError('Unknown profiling mode: {}. Choose from {}'.format(mode, MODES))
+		self.name = name
+		self.mode = mode
+		self.duration = duration
+		self.interval = interval
+		self.directory = directory
+
+		self.stage = 'idle'
+		self.running = False
+		self.lock = threading.Lock()  # stop() may be called by the loop and the sampler at once
+		self.end_time = 0
+		self.thread_id = None  # The profiled loop
+		self.sampler = None
+		self.stacks = {}  # Folded stack: count
+		self.call_stack = []  # [name, start, child time] per active call (deterministic)
+
+	@classmethod
+	def from_config(cls, name, conf):
+		''' Returns a Profiler for the profiling section of the config (None if missing) '''
+		options = conf.get('profiling')
+		if not options:
+			return None
+		return cls(name, mode=options.get('mode', SAMPLED), duration=options.get('duration', 30),
+				   interval=options.get('interval', 0.005), directory=options.get('directory', 'profiles'))
+
+	def install_signal(self):
+		''' Start profiling when the process receives SIGUSR1 (SIGBREAK on Windows) '''
+		signum = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+		if signum is None:
+			return
+		signal.signal(signum, lambda signum, frame: self.start())
+
+	def enter(self, stage):
+		''' Called by the loop when it starts a stage. Also ends the profile in time '''
+		self.stage = stage
+		if self.running and time.perf_counter() > self.end_time:
+			self.stop()
+
+	def start(self):
+		''' Starts profiling the calling thread for duration seconds '''
+		if self.running:
+			return
+		self.stacks = {}
+		self.thread_id = threading.get_ident()
+		self.end_time = time.perf_counter() + self.duration
+		self.running = True
+		print('Profiling {} ({}) for {}s'.format(self.name, self.mode, self.duration))
+
+		if self.mode == SAMPLED:
+			self.sampler = threading.Thread(target=self._sample, name='Profiler', daemon=True)
+			self.sampler.start()
+		else:
+			self.call_stack = []
+			sys.setprofile(self._trace)
+
+	def stop(self):
+		''' Stops profiling and writes the profile, returns its filename '''
+		with self.lock:
+			if not self.running:
+				return None
+			self.running = False
+		if self.mode == SAMPLED:
+			if self.sampler is not threading.current_thread():
+				self.sampler.join()
+		else:
+			sys.setprofile(None)
+		return self.write()
+
+	def _sample(self):
+		own_id = threading.get_ident()
+		names = {}
+		while self.running and time.perf_counter() < self.end_time:
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_id:
+					continue
+				stack = []
+				while frame is not None:
+					stack.append(_frame_name(frame.f_code))
+					frame = frame.f_back
+				if thread_id == self.thread_id:
+					stack.append(self.stage)
+				else:
+					if thread_id not in names:
+						names = {t.ident: t.name for t in threading.enumerate()}
+					stack.append('thread:{}'.format(names.get(thread_id, thread_id)))
+				key = ';'.join(reversed(stack))
+				self.stacks[key] = self.stacks.get(key, 0) + 1
+			time.sleep(self.interval)
+
+		if self.running:
+			# Duration passed without the loop calling enter, e.g. a hanging stage
+			self.stop()
+
+	def _trace(self, frame, event, arg):
+		now = time.perf_counter()
+		if event == 'call' or event == 'c_call':
+			name = _frame_name(frame.f_code) if event == 'call' else \
+				   'builtin:{}'.format(getattr(arg, '__qualname__', arg))
+			self.call_stack.append([name, now, 0.0])
+		elif len(self.call_stack) > 0:
+			# return, c_return or c_exception. Calls from before start are ignored
+			name, start, child_time = self.call_stack.pop()
+			total = now - start
+			key = ';'.join([self.stage] + [entry[0] for entry in self.call_stack] + [name])
+			self.stacks[key] = self.stacks.get(key, 0) + (total - child_time) * 1e6
+			if len(self.call_stack) > 0:
+				self.call_stack[-1][2] += total
+
+	def write(self):
+		os.makedirs(self.directory, exist_ok=True)
+		filename = os.path.join(self.directory, '{}_{}_{}.folded'.format(
+					self.name, self.mode, time.strftime('%Y%m%d_%H%M%S')))
+		with open(filename, 'w') as f:
+			for stack, count in sorted(self.stacks.items()):
+				if int(count) > 0:
+					f.write('{} {}\n'.format(stack, int(count)))
+		print('Profile written to {}'.format(filename))
+		return filename
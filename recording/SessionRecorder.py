@@ -0,0 +1,147 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+INDEX_FILE = 'index.jsonl'
+
+
+class SessionRecorder():
+	''' Append-only recorder for everything the decoder ingests.
+
+	Chunks are handed to write(), which only puts them on a bounded queue.
+	A background thread collects them per stream and saves a segment of
+	.npy files (data and timestamps) once segment_size samples are
+	collected, or at least every flush_interval seconds. Every segment is
+	appended to index.jsonl, so a crash only loses the unsaved tail.
+
+	If the queue is full the chunk is dropped and counted, the decoder
+	loop is never blocked by the disk. Segments can be memory-mapped for
+	offline replay, see iter_segments and read_stream.
+	'''
+
+	def __init__(self, directory, segment_size=10000, flush_interval=10, max_queue=1000):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.flush_interval = flush_interval
+
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.thread = None
+		self.running = False
+
+		self.buffers = {}      # stream: ([data], [timestamps])
+		self.segment_count = {}
+		self.last_flush = {}
+		self.n_dropped = 0
+
+	def start(self):
+		os.makedirs(self.directory, exist_ok=True)
+		self.running = True
+		self.thread = threading.Thread(target=self._run, name='SessionRecorder', daemon=True)
+		self.thread.start()
+
+	def write(self, stream, data, timestamps):
+		'''
+		Queue data [samples x channels] with a timestamp per sample for
+		stream. Returns False if the chunk was dropped.
+		'''
+		try:
+			self.queue.put_nowait((stream, data, timestamps))
+			return True
+		except queue.Full:
+			self.n_dropped += 1
+			return False
+
+	def stop(self):
+		''' Writes everything that is still queued and stops the writer '''
+		if self.thread is None:
+			return
+		self.queue.put((None, None, None))
+		self.thread.join()
+		self.thread = None
+		if self.n_dropped > 0:
+			print('Recorder dropped {} chunks (queue full)'.format(self.n_dropped))
+
+	def _run(self):
+		while True:
+			try:
+				stream, data, timestamps = self.queue.get(timeout=1.0)
+			except queue.Empty:
+				self._flush_stale()
+				continue
+
+			if stream is None:
+				break
+
+			data_buffer, ts_buffer = self.buffers.setdefault(stream, ([], []))
+			data_buffer.extend(data)
+			ts_buffer.extend(timestamps)
+			self.last_flush.setdefault(stream, time.time())
+
+			if len(ts_buffer) >= self.segment_size:
+				self._flush(stream)
+			else:
+				self._flush_stale()
+
+		for stream in list(self.buffers):
+			self._flush(stream)
+
+	def _flush_stale(self):
+		now = time.time()
+		for stream in list(self.buffers):
+			if now - self.last_flush[stream] >= self.flush_interval:
+				self._flush(stream)
+
+	def _flush(self, stream):
+		''' Saves the buffered samples of stream as a new segment '''
+		data_buffer, ts_buffer = self.buffers[stream]
+		self.last_flush[stream] = time.time()
+		if len(ts_buffer) == 0:
+			return
+
+		n = self.segment_count.get(stream, 0)
+		name = '{}_{:05d}'.format(stream, n)
+		data = np.array(data_buffer)
+		timestamps = np.array(ts_buffer, dtype=np.float64)
+		np.save(os.path.join(self.directory, name + '.npy'), data)
+		np.save(os.path.join(self.directory, name + '_ts.npy'), timestamps)
+
+		entry = {'stream': stream,
+				 'segment': n,
+				 'file': name,
+				 'n_samples': len(timestamps),
+				 'first_timestamp': float(timestamps[0]),
+				 'last_timestamp': float(timestamps[-1])}
+		with open(os.path.join(self.directory, INDEX_FILE), 'a') as f:
+			f.write(json.dumps(entry) + '\n')
+
+		self.buffers[stream] = ([], [])
+		self.segment_count[stream] = n + 1
+
+
+def read_index(directory):
+	''' Returns all index entries of a recorded session '''
+	with open(os.path.join(directory, INDEX_FILE), 'r') as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+
+def iter_segments(directory, stream, mmap_mode='r'):
+	''' Yields (data, timestamps) of every segment of stream, memory-mapped by default '''
+	for entry in read_index(directory):
+		if entry['stream'] != stream:
+			continue
+		path = os.path.join(directory, entry['file'])
+		yield (np.load(path + '.npy', mmap_mode=mmap_mode),
+			   np.load(path + '_ts.npy', mmap_mode=mmap_mode))
+
+
+def read_stream(directory, stream):
+	''' Returns all data and timestamps of stream as two arrays '''
+	segments = list(iter_segments(directory, stream))
+	if len(segments) == 0:
+		return np.empty((0,)), np.empty((0,))
+	return (np.concatenate([data for data, _ in segments]),
+			np.concatenate([timestamps for _, timestamps in segments]))
@@ -0,0 +1,106 @@
+import bisect
+
+# Channels of the frame telemetry stream
+FLIP_TIME = 0
+DROPPED = 1
+N_CHANNELS = 2
+
+
+class FrameTelemetry():
+	''' UI side of the frame telemetry stream.
+
+	Collects the (LSL clock) time of every flip and whether the frame was
+	dropped, and publishes them every flush_interval seconds (or
+	batch_size frames), so pushing to LSL costs almost nothing per frame
+	while the decoder still gets the frames of a window shortly after it
+	ends. A frame counts as dropped when the interval since the previous
+	flip exceeds refresh_threshold seconds.
+
+	Each sample is [flip_time, dropped]. The flip time is sent as a channel
+	because push_chunk only timestamps the chunk as a whole.
+	'''
+
+	def __init__(self, outlet, refresh_threshold, batch_size=30, flush_interval=0.1):
+		self.outlet = outlet
+		self.refresh_threshold = refresh_threshold
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+
+		self.last_flip = None
+		self.samples = []
+
+	def flipped(self, flip_time):
+		''' Register a flip. Call directly after win.flip() '''
+		dropped = self.last_flip is not None and \
+				  flip_time - self.last_flip > self.refresh_threshold
+		self.samples.append([flip_time, float(dropped)])
+		self.last_flip = flip_time
+
+		if len(self.samples) >= self.batch_size or \
+		   flip_time - self.samples[0][FLIP_TIME] >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		''' Push all collected frames '''
+		if self.samples:
+			self.outlet.push_chunk(self.samples, self.samples[-1][FLIP_TIME])
+			self.samples = []
+
+	def pause(self):
+		''' Push all collected frames and don't count the time until the next
+		flip as a drop, e.g. between trials. '''
+		self.flush()
+		self.last_flip = None
+
+
+class FrameTimeline():
+	''' Decoder side of the frame telemetry stream.
+
+	Keeps the flip times and drop flags received from the UI (at most
+	max_frames), so classification windows can be checked for dropped
+	frames and the actual frame rate can be measured.
+	'''
+
+	def __init__(self, max_frames=2400):
+		self.max_frames = max_frames
+
+		self.flip_times = []
+		self.dropped = []
+
+	def extend(self, samples):
+		''' Add samples pulled from the frame telemetry inlet '''
+		for sample in samples:
+			self.flip_times.append(sample[FLIP_TIME])
+			self.dropped.append(bool(sample[DROPPED]))
+
+		if len(self.flip_times) > 2 * self.max_frames:
+			self.flip_times = self.flip_times[-self.max_frames:]
+			self.dropped = self.dropped[-self.max_frames:]
+
+	def span(self, t_start, t_stop):
+		''' Indices of the first and last+1 flip between t_start and t_stop '''
+		return (bisect.bisect_left(self.flip_times, t_start),
+				bisect.bisect_right(self.flip_times, t_stop))
+
+	def covers(self, t):
+		''' True if flips up to time t have been received '''
+		return len(self.flip_times) > 0 and self.flip_times[-1] >= t
+
+	def dropped_frames(self, t_start, t_stop):
+		''' Number of dropped frames between t_start and t_stop '''
+		start, stop = self.span(t_start, t_stop)
+		return sum(self.dropped[start:stop])
+
+	def frame_rate(self, t_start=None, t_stop=None):
+		'''
+		Measured frame rate (Hz) between t_start and t_stop, default over all
+		received flips. Returns None if there are not enough flips.
+		'''
+		start, stop = self.span(t_start if t_start is not None else float('-inf'),
+								t_stop if t_stop is not None else float('inf'))
+		if stop - start < 2:
+			return None
+		duration = self.flip_times[stop-1] - self.flip_times[start]
+		if duration <= 0:
+			return None
+		return (stop - start - 1) / duration
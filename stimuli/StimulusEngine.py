@@ -0,0 +1,106 @@
+import numpy as np
+
+# Stimulus modes
+FLASH = 'flash'            # Single frame flash every period
+SQUARE = 'square'          # On for the first half of every period
+SINUSOIDAL = 'sinusoidal'  # Sampled sinusoidal luminance (JFPM)
+
+MODES = (FLASH, SQUARE, SINUSOIDAL)
+
+
+def effective_frequency(frequency, refresh_rate, mode=FLASH):
+	'''
+	Returns the frequency (Hz) that is actually shown on a monitor with the
+	given refresh rate. Flash and square-wave stimuli need a whole number of
+	frames per period, so their frequency is rounded to the closest
+	refresh_rate/n. Sinusoidal stimuli are sampled per frame and keep their
+	frequency (as long as it is below half the refresh rate).
+	'''
+	if mode == SINUSOIDAL:
+		return float(frequency)
+	period = max(1, int(round(refresh_rate / frequency)))
+	return refresh_rate / period
+
+
+class StimulusEngine():
+	''' Decides what every flickering stimulus shows on each frame.
+
+	build_schedule precomputes the integer period and frame shift of
+	every flash and square-wave stimulus, and the cycles per frame and
+	phase of every sinusoidal stimulus. The frame loop then computes the
+	state of all stimuli at frame fnum at once from these, draws the
+	stimuli that are on and only touches the opacity of stimuli whose
+	luminance changed since the previous flip.
+
+	The state is computed from the frame number itself instead of looked
+	up in a table of a limited length, so every stimulus keeps its exact
+	period however long the loop runs (a table that wraps would break the
+	period of any stimulus whose period doesn't divide its length).
+
+	Stimuli are given as a frequency in Hz and an optional phase in
+	radians. The frame coding depends on the refresh rate, see
+	effective_frequency. Flash and square-wave stimuli can only start
+	on a frame, so their phase is rounded to a whole frame of the period.
+	'''
+
+	def __init__(self, refresh_rate, mode=FLASH):
+		if mode not in MODES:
+			raise ValueError('Unknown stimulus mode: {}. Choose from {}'.format(mode, MODES))
+		self.refresh_rate = refresh_rate
+		self.mode = mode
+
+		self.objects = []
+		self.frequencies = []
+		self.phases = []
+
+		self.periods = None           # Frames per period (flash, square)
+		self.shifts = None            # Frames the period is shifted by the phase (flash, square)
+		self.cycles_per_frame = None  # (sinusoidal)
+		self.phase_cycles = None      # Phase in cycles (sinusoidal)
+		self.last_luminance = []
+
+	def add_stim(self, obj, frequency, phase=0):
+		self.objects += [obj]
+		self.frequencies += [effective_frequency(frequency, self.refresh_rate, self.mode)]
+		self.phases += [phase]
+		self.last_luminance += [None]
+
+	def build_schedule(self):
+		''' Precompute the timing of all stimuli, call after the last add_stim '''
+		frequencies = np.array(self.frequencies, dtype=np.float64)
+		phase_cycles = np.mod(np.array(self.phases, dtype=np.float64) / (2*np.pi), 1)
+
+		if self.mode == SINUSOIDAL:
+			self.cycles_per_frame = frequencies / self.refresh_rate
+			self.phase_cycles = phase_cycles
+		else:
+			self.periods = np.round(self.refresh_rate / frequencies).astype(np.int64)
+			self.shifts = np.round(phase_cycles * self.periods).astype(np.int64)
+		self.last_luminance = [None] * len(self.objects)
+
+	def state(self, fnum):
+		''' Visibility and luminance [stimuli] of all stimuli in frame fnum '''
+		if self.mode == SINUSOIDAL:
+			cycle = np.mod(fnum * self.cycles_per_frame + self.phase_cycles, 1)
+			luminance = 0.5 * (1 + np.sin(2*np.pi*cycle))
+			return luminance > 0, luminance
+
+		position = np.mod(fnum + self.shifts, self.periods)
+		if self.mode == FLASH:
+			visible = position == 0
+		else:
+			visible = position < self.periods / 2
+		return visible, visible.astype(np.float64)
+
+	def draw(self, fnum):
+		''' Draw all stimuli that are on in frame fnum '''
+		visible, luminance = self.state(fnum)
+		for i, obj in enumerate(self.objects):
+			if not visible[i]:
+				continue
+			if self.mode == SINUSOIDAL:
+				lum = luminance[i]
+				if lum != self.last_luminance[i]:
+					obj.opacity = lum
+					self.last_luminance[i] = lum
+			obj.draw()
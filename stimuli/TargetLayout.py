@@ -0,0 +1,93 @@
+import math
+from collections import namedtuple
+
+# Layouts (config: ui: layout)
+DIRECTIONS = 'directions'  # One stimulus per side of the screen (top, bottom, left, right)
+GRID = 'grid'              # Speller: rows x columns of symbols (config: experiment: speller)
+
+LAYOUTS = (DIRECTIONS, GRID)
+
+# Center of the stimulus of each direction (norm units)
+DIRECTION_POSITIONS = {'top': (0, 1), 'bottom': (0, -1), 'left': (-1, 0), 'right': (1, 0)}
+
+# name: direction or symbol, frequency: Hz, phase: radians, pos and size: norm units
+Target = namedtuple('Target', ['name', 'frequency', 'phase', 'pos', 'size'])
+
+
+class TargetLayout():
+	''' The stimulus targets of the experiment, shared by the UIs and the decoder.
+
+	The decoder sends the index of the classified target as command and
+	len(targets) if no target was classified (see nothing). The targets
+	are, in this order:
+		directions: the entries of experiment: stimulusFrequencies (and
+					stimulusPhases, in multiples of pi)
+		grid:		the symbols of experiment: speller, row by row. Target
+					i flickers at startFrequency + i*frequencyStep with phase
+					i*phaseStep (joint frequency and phase modulation, JFPM).
+	'''
+
+	def __init__(self, conf):
+		self.layout = conf['ui'].get('layout', DIRECTIONS)
+		if self.layout not in LAYOUTS:
+			raise ValueError('Unknown layout: {}. Choose from {}'.format(self.layout, LAYOUTS))
+
+		self.rows = self.columns = None
+		if self.layout == GRID:
+			self.targets = self._grid_targets(conf['experiment']['speller'])
+		else:
+			self.targets = self._direction_targets(conf['experiment'])
+
+	def _direction_targets(self, experiment):
+		phases = experiment.get('stimulusPhases') or {}
+		return [Target(name, frequency, math.pi * phases.get(name, 0),
+					   DIRECTION_POSITIONS.get(name, (0, 0)), (1, 1))
+				for name, frequency in experiment['stimulusFrequencies'].items()]
+
+	def _grid_targets(self, speller):
+		self.rows, self.columns = speller['rows'], speller['columns']
+		symbols = list(speller['symbols'])
+		if len(symbols) != self.rows * self.columns:
+			raise ValueError('The speller has {} symbols for {}x{} targets'
+							 .format(len(symbols), self.rows, self.columns))
+
+		cell_width, cell_height = 2 / self.columns, 2 / self.rows
+		size = (cell_width * speller.get('targetSize', 0.8), cell_height * speller.get('targetSize', 0.8))
+		targets = []
+		for i, symbol in enumerate(symbols):
+			row, column = divmod(i, self.columns)
+			pos = (-1 + (column + 0.5) * cell_width, 1 - (row + 0.5) * cell_height)
+			targets += [Target(symbol,
+							   speller['startFrequency'] + i * speller['frequencyStep'],
+							   math.pi * ((i * speller['phaseStep']) % 2),
+							   pos, size)]
+		return targets
+
+	def __len__(self):
+		return len(self.targets)
+
+	def __iter__(self):
+		return iter(self.targets)
+
+	def __getitem__(self, index):
+		return self.targets[index]
+
+	@property
+	def names(self):
+		return [target.name for target in self.targets]
+
+	@property
+	def frequencies(self):
+		return [target.frequency for target in self.targets]
+
+	@property
+	def nothing(self):
+		''' Command sent when no target was classified '''
+		return len(self.targets)
+
+	@property
+	def command_mapping(self):
+		''' Target name (and 'nothing'): command '''
+		mapping = {target.name: i for i, target in enumerate(self.targets)}
+		mapping['nothing'] = self.nothing
+		return mapping
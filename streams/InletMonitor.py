@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class InletMonitor():
+	''' Pulls the chunks of a regularly sampled inlet and keeps track of backlog and loss.
+
+	Backlog: after every pull the number of samples still queued in the
+	inlet is read (samples_available). The next pull is sized to take
+	all of them (at least min_pull, at most max_pull samples), so a loop
+	that fell behind catches up in a few iterations instead of pulling a
+	fixed amount until the inlet's buffer overflows and drops samples.
+
+	Loss: consecutive timestamps should be 1/nominal_srate apart. A step
+	of more than gap_tolerance sample periods (also between chunks) is a
+	gap of round(step * nominal_srate) - 1 lost samples. pull_chunk
+	returns the gaps, so the caller can fill them and keep the sample
+	index in step with time.
+
+	Counters: n_pulls, n_full_pulls (pulls that hit the pull size),
+	queue_depth / max_queue_depth (samples), n_gaps and n_lost (samples).
+	'''
+
+	def __init__(self, inlet, nominal_srate, min_pull=1024, max_pull=None, gap_tolerance=10):
+		self.inlet = inlet
+		self.nominal_srate = nominal_srate
+		self.min_pull = min_pull
+		self.max_pull = max_pull if max_pull is not None else max(min_pull, int(10 * nominal_srate))
+		self.gap_tolerance = gap_tolerance
+
+		self.pull_size = min_pull
+		self.last_timestamp = None
+
+		self.n_pulls = 0
+		self.n_full_pulls = 0
+		self.queue_depth = 0
+		self.max_queue_depth = 0
+		self.n_gaps = 0
+		self.n_lost = 0
+
+	def reset(self, inlet=None):
+		''' Starts over after a reconnect, the counters are kept '''
+		if inlet is not None:
+			self.inlet = inlet
+		self.pull_size = self.min_pull
+		self.last_timestamp = None
+
+	def pull_chunk(self):
+		'''
+		Pulls the available samples, returns the chunk, its timestamps and
+		the gaps in it as a list of (position in chunk, number of lost
+		samples before that position).
+		'''
+		chunk, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=self.pull_size)
+		if len(chunk) == 0:
+			return chunk, timestamps, []
+
+		self.n_pulls += 1
+		if len(chunk) >= self.pull_size:
+			self.n_full_pulls += 1
+
+		self.queue_depth = self.inlet.samples_available()
+		self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+		self.pull_size = min(max(self.min_pull, self.queue_depth), self.max_pull)
+
+		gaps = self.find_gaps(timestamps)
+		self.last_timestamp = timestamps[-1]
+		return chunk, timestamps, gaps
+
+	def find_gaps(self, timestamps):
+		''' Gaps in timestamps (continuing from the previous chunk), see pull_chunk '''
+		if self.nominal_srate <= 0:
+			return []
+		previous = timestamps[0] if self.last_timestamp is None else self.last_timestamp
+		steps = np.diff(np.asarray(timestamps, dtype=np.float64), prepend=previous) * self.nominal_srate
+
+		positions = np.flatnonzero(steps > self.gap_tolerance)
+		gaps = [(int(pos), int(round(steps[pos])) - 1) for pos in positions]
+		self.n_gaps += len(gaps)
+		self.n_lost += sum(n_lost for _, n_lost in gaps)
+		return gaps
+
+	def report(self):
+		return ('{} samples lost in {} gaps, {}/{} pulls were full, max queue depth {} samples ({:.2f}s)'
+				.format(self.n_lost, self.n_gaps, self.n_full_pulls, self.n_pulls, self.max_queue_depth,
+						self.max_queue_depth / self.nominal_srate if self.nominal_srate > 0 else 0))
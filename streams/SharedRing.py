@@ -0,0 +1,366 @@
+'''
+Copyright (C) 2019 Maarten Ottenhoff.
+You may use, distribute and modify this code under the
+terms of the MIT license.
+
+Shared memory transport for the single channel streams between the
+decoder and the UI (commands and markers) when both run on the same
+machine. RingOutlet and RingInlet have the same push_sample/pull_sample/
+pull_chunk/time_correction methods as the LSL outlet and inlet, so the
+rest of the code doesn't know which transport is used.
+
+Every stream is a ring of fixed size slots in a shared memory block,
+written by one process and read by one other. Nothing is locked:
+	- the writer marks the slot as busy (seq = -1), writes the timestamp
+	  and value, writes the sample number in seq and then increments the
+	  write count in the header.
+	- the reader copies all slots up to the write count and checks the
+	  sequence numbers again afterwards. Samples that were overwritten in
+	  the meantime (the reader is more than `capacity` samples behind) are
+	  counted in n_lost instead of returned half written.
+The outlet removes the block when it is closed. Every block has a random
+id, so a reader notices when the writer was restarted with a new block
+under the same name (checked while no samples come in) and switches to it.
+Timestamps are taken with pylsl's local_clock, the same host clock LSL
+uses, so they can be compared directly with the timestamps of the EEG.
+
+Requires python 3.8 or later (multiprocessing.shared_memory). It is only
+imported when a ring is opened, so the LSL transport still works on 3.7.
+
+Latency benchmark against LSL on loopback (from the repository root):
+	python -m streams.SharedRing --benchmark
+'''
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from pylsl import local_clock
+
+# channel_format (as in LSL) -> numpy type of the value in a slot
+FORMATS = {'int8': 'i8', 'int16': 'i8', 'int32': 'i8', 'int64': 'i8',
+		   'float32': 'f8', 'double64': 'f8', 'string': 'S'}
+FORMAT_NAMES = list(FORMATS)
+
+HEADER = 5  # write count, capacity, format index, max string length, block id
+BLOCK_ID = 4
+PREFIX = 'ssvep_'  # Name of the shared memory block is PREFIX + stream name
+MAX_LENGTH = 128  # Default longest string sample (bytes, UTF-8)
+
+
+def _shared_memory():
+	try:
+		from multiprocessing import shared_memory
+	except ImportError:
+		raise ImportError('The shared_memory transport requires python 3.8 or later, '
+						  'use transport: lsl') from None
+	return shared_memory
+
+
+def _open(name):
+	''' Opens the existing block of a stream (FileNotFoundError if there is none) '''
+	shm = _shared_memory().SharedMemory(PREFIX + name)
+	if os.name == 'posix':
+		# Only the outlet may remove the block when its process exits
+		from multiprocessing import resource_tracker
+		resource_tracker.unregister(shm._name, 'shared_memory')
+	return shm
+
+
+def _block_id(shm):
+	header = np.ndarray((HEADER,), dtype=np.int64, buffer=shm.buf)
+	block_id = int(header[BLOCK_ID])
+	del header
+	return block_id
+
+
+def _slot_dtype(channel_format, max_length):
+	value = FORMATS[channel_format]
+	if value == 'S':
+		value = 'S{:d}'.format(max_length)
+	return np.dtype([('seq', 'i8'), ('timestamp', 'f8'), ('value', value)])
+
+
+def _map(shm, capacity, dtype):
+	header = np.ndarray((HEADER,), dtype=np.int64, buffer=shm.buf)
+	slots = np.ndarray((capacity,), dtype=dtype, buffer=shm.buf, offset=HEADER*8)
+	return header, slots
+
+
+class RingOutlet():
+	'''
+	Writing end of a ring, replaces a single channel StreamOutlet. String
+	samples longer than max_length bytes raise a ValueError, since the
+	slots have a fixed size.
+	'''
+
+	def __init__(self, name, channel_format, capacity=1024, max_length=MAX_LENGTH):
+		self.name = name
+		self.channel_format = channel_format
+		self.capacity = capacity
+		self.max_length = max_length
+		dtype = _slot_dtype(channel_format, max_length)
+		shared_memory = _shared_memory()
+
+		# A block left behind by a crashed session is replaced, readers of
+		# the old block switch to the new one (see RingInlet)
+		try:
+			stale = shared_memory.SharedMemory(PREFIX + name)
+			stale.close()
+			stale.unlink()
+		except FileNotFoundError:
+			pass
+		layout = [capacity, FORMAT_NAMES.index(channel_format), max_length]
+		try:
+			self.shm = shared_memory.SharedMemory(PREFIX + name, create=True,
+												  size=HEADER*8 + capacity*dtype.itemsize)
+		except FileExistsError:
+			# Windows keeps the old block while a reader has it open, so it is
+			# continued instead. Its readers just keep reading
+			self.shm = shared_memory.SharedMemory(PREFIX + name)
+			header = np.ndarray((HEADER,), dtype=np.int64, buffer=self.shm.buf)
+			existing = [int(v) for v in header[1:BLOCK_ID]]
+			del header
+			if existing != layout:
+				self.shm.close()
+				raise RuntimeError('Shared memory stream {} is still open with other settings'.format(name))
+			self.header, self.slots = _map(self.shm, capacity, dtype)
+			self.n_written = int(self.header[0])
+		else:
+			self.header, self.slots = _map(self.shm, capacity, dtype)
+			self.slots['seq'] = -1
+			self.header[:] = [0] + layout + [int.from_bytes(os.urandom(7), 'little')]
+			self.n_written = 0
+
+	def push_sample(self, sample, timestamp=0.0):
+		''' Writes sample (a list with one value), timestamp 0 means now '''
+		value = sample[0]
+		if self.channel_format == 'string':
+			value = value.encode()
+			if len(value) > self.max_length:
+				raise ValueError('Sample of {} is {} bytes, more than the {} of the shared memory stream '
+								 '(config: streams: sharedMemory: maxStringLength)'
+								 .format(self.name, len(value), self.max_length))
+		i = self.n_written % self.capacity
+
+		self.slots['seq'][i] = -1
+		self.slots['timestamp'][i] = timestamp if timestamp != 0.0 else local_clock()
+		self.slots['value'][i] = value
+		self.slots['seq'][i] = self.n_written
+		self.n_written += 1
+		self.header[0] = self.n_written
+
+	def push_chunk(self, samples, timestamp=0.0):
+		for sample in samples:
+			self.push_sample(sample, timestamp)
+
+	def close(self):
+		''' Removes the block, readers that still have it open can read what is left '''
+		del self.header, self.slots
+		self.shm.close()
+		try:
+			self.shm.unlink()
+		except FileNotFoundError:
+			pass  # Already replaced by a new outlet
+
+
+class RingInlet():
+	'''
+	Reading end of a ring, replaces a single channel StreamInlet. Raises
+	FileNotFoundError if the outlet does not exist (yet), see open_inlet.
+	Only samples written after the inlet is opened are returned, and all
+	samples of a new block if the outlet is replaced.
+	'''
+
+	def __init__(self, name, poll_interval=0.0005, reopen_interval=0.5):
+		self.name = name
+		self.poll_interval = poll_interval  # Seconds between checks if pulling with a timeout
+		self.reopen_interval = reopen_interval  # Seconds between checks for a new block while idle
+
+		self.shm = None
+		self.n_lost = 0
+		self.n_reopened = 0
+		self.last_check = time.perf_counter()
+		self._attach(_open(name))
+		self.n_read = int(self.header[0])
+
+	def _attach(self, shm):
+		if self.shm is not None:
+			self.close()
+		self.shm = shm
+		header = np.ndarray((HEADER,), dtype=np.int64, buffer=self.shm.buf)
+		_, capacity, format_index, max_length, self.block_id = [int(v) for v in header]
+		del header
+		self.capacity = capacity
+		self.channel_format = FORMAT_NAMES[format_index]
+		self.header, self.slots = _map(self.shm, capacity,
+									   _slot_dtype(self.channel_format, max_length))
+		self.n_read = 0
+
+	def _check_replaced(self):
+		''' Switches to the block of a new outlet with the same name, if there is one '''
+		self.last_check = time.perf_counter()
+		try:
+			shm = _open(self.name)
+		except FileNotFoundError:
+			return  # The outlet is gone, maybe a new one is started later
+		if _block_id(shm) == self.block_id:
+			shm.close()
+			return
+		self._attach(shm)
+		self.n_reopened += 1
+		print('Shared memory stream {} was restarted, switched to the new block'.format(self.name))
+
+	def time_correction(self, timeout=None):
+		''' Both ends use the clock of this machine '''
+		return 0.0
+
+	def _pull(self, max_samples):
+		n_written = int(self.header[0])
+		if n_written - self.n_read > self.capacity:
+			self.n_lost += n_written - self.capacity - self.n_read
+			self.n_read = n_written - self.capacity
+		stop = min(n_written, self.n_read + max_samples)
+		if stop == self.n_read:
+			if time.perf_counter() - self.last_check > self.reopen_interval:
+				self._check_replaced()
+			return [], []
+
+		expected = np.arange(self.n_read, stop)
+		indices = expected % self.capacity
+		data = self.slots[indices]
+		# Slots that were (being) overwritten while copying are lost
+		valid = (data['seq'] == expected) & (self.slots['seq'][indices] == expected)
+		self.n_lost += len(expected) - int(valid.sum())
+		self.n_read = stop
+
+		data = data[valid]
+		if self.channel_format == 'string':
+			values = [value.decode() for value in data['value']]
+		else:
+			values = data['value'].tolist()
+		return [[value] for value in values], data['timestamp'].tolist()
+
+	def _wait(self, pull, timeout):
+		result = pull()
+		end = time.perf_counter() + timeout
+		while len(result[0]) == 0 and time.perf_counter() < end:
+			time.sleep(self.poll_interval)
+			result = pull()
+		return result
+
+	def pull_sample(self, timeout=0.0):
+		''' Returns the next sample and its timestamp, or (None, None) after timeout seconds '''
+		samples, timestamps = self._wait(lambda: self._pull(1), timeout)
+		if len(samples) == 0:
+			return None, None
+		return samples[0], timestamps[0]
+
+	def pull_chunk(self, timeout=0.0, max_samples=1024):
+		''' Returns all new samples (at most max_samples) and their timestamps '''
+		return self._wait(lambda: self._pull(max_samples), timeout)
+
+	def close(self):
+		del self.header, self.slots
+		self.shm.close()
+
+
+def open_inlet(name):
+	''' Returns a RingInlet for the stream, or None if its outlet does not exist yet '''
+	try:
+		return RingInlet(name)
+	except FileNotFoundError:
+		return None
+
+
+def shared_memory_streams(conf):
+	''' Names of the streams that use shared memory according to the config '''
+	streams = conf['streams']
+	if streams.get('transport', 'lsl') != 'shared_memory':
+		return []
+	return list((streams.get('sharedMemory') or {}).get('streams', []))
+
+
+def max_string_length(conf):
+	''' Longest string sample (bytes) of the shared memory streams according to the config '''
+	return int((conf['streams'].get('sharedMemory') or {}).get('maxStringLength', MAX_LENGTH))
+
+
+BENCHMARK_STREAM = 'SSVEPBenchmark'
+
+
+def receive(transport, n_samples):
+	'''
+	Benchmark receiver, runs in a separate process like the UI or decoder.
+	Prints 'ready' when connected and the latency of every marker at the end.
+	'''
+	if transport == 'lsl':
+		from pylsl import StreamInlet, resolve_byprop
+		inlet = StreamInlet(resolve_byprop('name', BENCHMARK_STREAM, 1, 10)[0])
+		inlet.open_stream()
+	else:
+		inlet = None
+		while inlet is None:
+			inlet = open_inlet(BENCHMARK_STREAM)
+			time.sleep(0.01)
+	print('ready', flush=True)
+
+	latencies = []
+	deadline = time.perf_counter() + 10 + n_samples * 0.01
+	while len(latencies) < n_samples and time.perf_counter() < deadline:
+		sample, timestamp = inlet.pull_sample(timeout=0.0)  # Busy wait, measures the transport only
+		if sample is not None:
+			latencies += [local_clock() - timestamp]
+	print(' '.join('{:.9f}'.format(latency) for latency in latencies), flush=True)
+
+
+def benchmark(n_samples=2000, interval=0.001):
+	''' Prints the one way latency of markers over LSL (loopback) and shared memory '''
+	from pylsl import StreamInfo, StreamOutlet
+
+	print('{} markers, {:.1f} ms apart, latency in us:'.format(n_samples, interval*1000))
+	print('\t{:<15s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('transport', 'median', 'mean', 'p99', 'max'))
+	for transport in ['lsl', 'shared_memory']:
+		if transport == 'lsl':
+			outlet = StreamOutlet(StreamInfo(BENCHMARK_STREAM, 'Markers', 1, 0, 'string', 'benchmark1'))
+		else:
+			outlet = RingOutlet(BENCHMARK_STREAM, 'string')
+
+		receiver = subprocess.Popen([sys.executable, '-m', 'streams.SharedRing', '--receive', transport,
+									 '--samples', str(n_samples)],
+									stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+		while receiver.stdout.readline().strip() != 'ready':
+			pass
+		time.sleep(0.5)
+
+		for i in range(n_samples):
+			outlet.push_sample(['marker_{}'.format(i)])
+			time.sleep(interval)
+
+		latencies = np.array(receiver.stdout.readline().split(), dtype=np.float64) * 1e6
+		receiver.wait()
+		if transport != 'lsl':
+			outlet.close()
+		del outlet
+
+		if len(latencies) < n_samples:
+			print('\t{}: only {} of {} markers received'.format(transport, len(latencies), n_samples))
+		print('\t{:<15s} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+			  transport, np.median(latencies), latencies.mean(),
+			  np.percentile(latencies, 99), latencies.max()))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Shared memory transport for commands and markers')
+	parser.add_argument('--benchmark', action='store_true',
+						help='Compare the latency with LSL on loopback')
+	parser.add_argument('--samples', type=int, default=2000)
+	parser.add_argument('--receive', choices=['lsl', 'shared_memory'], help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.receive is not None:
+		receive(args.receive, args.samples)
+	elif args.benchmark:
+		benchmark(args.samples)
@@ -0,0 +1,115 @@
+import threading
+
+import numpy as np
+
+
+class StreamClock():
+	''' Puts the timestamps of an LSL inlet on the local (decoder) clock.
+
+	The clock offset of the sending host is queried with time_correction()
+	every offset_interval seconds on a background thread, so the decoder
+	loop never waits for it, and added to all timestamps.
+
+	For regularly sampled streams (nominal_srate > 0) every sample also
+	gets an index. A linear regression time = a + b*index is fitted online
+	from running sums with exponential forgetting (half_life in seconds of
+	data), so each chunk costs O(1) in state. The fitted line replaces the
+	jittery timestamps, and window boundaries can be computed from the
+	sample index (see index_at) instead of searched for in the buffer.
+	'''
+
+	def __init__(self, inlet, nominal_srate=0, half_life=30, offset_interval=5, first_index=0):
+		self.inlet = inlet
+		self.nominal_srate = nominal_srate
+		self.offset_interval = offset_interval
+
+		self.offset = 0.0
+		self.thread = None
+		self.stopped = threading.Event()
+
+		# Regression of time on sample index, relative to (index0, time0)
+		samples = half_life * nominal_srate if nominal_srate > 0 else 1
+		self.forgetting = 0.5 ** (1 / samples)
+		self.n_samples = first_index  # Index of the next sample
+		self.index0 = None
+		self.time0 = None
+		self.sums = np.zeros(5)  # weight, index, time, index^2, index*time
+		self.intercept = 0.0
+		self.slope = 1 / nominal_srate if nominal_srate > 0 else 0
+
+	def start(self):
+		''' Starts querying the clock offset in the background '''
+		self.thread = threading.Thread(target=self._run, name='StreamClock', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def _run(self):
+		while not self.stopped.is_set():
+			try:
+				self.offset = self.inlet.time_correction(timeout=self.offset_interval)
+			except Exception:
+				pass  # Keep the last offset, e.g. on a timeout
+			self.stopped.wait(self.offset_interval)
+
+	def correct(self, timestamps):
+		''' Returns the timestamps of a chunk on the local clock, dejittered for regular streams '''
+		timestamps = np.asarray(timestamps, dtype=np.float64) + self.offset
+		if self.nominal_srate <= 0 or len(timestamps) == 0:
+			return timestamps
+
+		indices = np.arange(self.n_samples, self.n_samples + len(timestamps), dtype=np.float64)
+		self.n_samples += len(timestamps)
+		self._fit(indices, timestamps)
+
+		if self.sums[0] < 2 or self.slope <= 0:
+			return timestamps
+		return self.time_at(indices)
+
+	def _fit(self, indices, timestamps):
+		if self.index0 is None:
+			self.index0, self.time0 = indices[0], timestamps[0]
+
+		# Keep the sums centered on recent data for numerical precision
+		if indices[-1] - self.index0 > 10 * (1 / (1 - self.forgetting)) and self.sums[0] > 0:
+			self._rebase(indices[0], self.time_at(indices[0]))
+
+		i = indices - self.index0
+		t = timestamps - self.time0
+		weights = self.forgetting ** (len(i) - 1 - np.arange(len(i)))
+		chunk_sums = np.array([weights.sum(), weights @ i, weights @ t,
+							   weights @ (i*i), weights @ (i*t)])
+		self.sums = self.forgetting ** len(i) * self.sums + chunk_sums
+
+		w, si, st, sii, sit = self.sums
+		variance = sii*w - si*si
+		if w < 2 or variance <= 0:
+			return
+		self.slope = (sit*w - si*st) / variance
+		self.intercept = (st - self.slope*si) / w
+
+	def _rebase(self, index0, time0):
+		''' Moves the origin of the regression to (index0, time0) '''
+		d_i = index0 - self.index0
+		d_t = time0 - self.time0
+		w, si, st, sii, sit = self.sums
+		self.sums = np.array([w,
+							  si - d_i*w,
+							  st - d_t*w,
+							  sii - 2*d_i*si + d_i*d_i*w,
+							  sit - d_i*st - d_t*si + d_i*d_t*w])
+		self.intercept += self.slope*d_i - d_t
+		self.index0, self.time0 = index0, time0
+
+	def time_at(self, index):
+		''' Local time of the sample with the given index (or array of indices) '''
+		return self.time0 + self.intercept + self.slope * (np.asarray(index) - self.index0)
+
+	def index_at(self, time):
+		''' Index (float) of the sample at the given local time '''
+		return self.index0 + (time - self.time0 - self.intercept) / self.slope
+
+	@property
+	def fitted(self):
+		return self.index0 is not None and self.sums[0] >= 2 and self.slope > 0